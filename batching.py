@@ -0,0 +1,82 @@
+import numpy as np
+
+# Batch formation policies for a stream of sequence lengths. Each policy
+# returns a list of int32 arrays of sequence lengths, one per batch, like
+# run_utils.get_nlp_batches.
+#
+# fifo:     consecutive chunks of batch_size sequences.
+# bucket:   sequences are queued by length bucket (bucket_width wide) and
+#           a batch is emitted when a bucket holds batch_size sequences.
+# tokens:   consecutive sequences are added to a batch while the batch,
+#           padded to its longest sequence, stays within max_tokens (and
+#           within batch_size sequences).
+# binpack:  sequences are packed first-fit-decreasing into rows of max_len
+#           tokens and batch_size rows form a batch. The returned lengths
+#           are the packed row lengths, so a runner sees one sequence per
+#           row. Attention across packed sequences would need a block
+#           diagonal mask, which the runners do not model.
+POLICIES = ['fifo', 'bucket', 'tokens', 'binpack']
+
+def chunk(lengths, batch_size):
+    return [np.array(lengths[i:i + batch_size], 'int32') for i in range(0, len(lengths), batch_size)]
+
+def form_fifo(lengths, batch_size):
+    return chunk(lengths, batch_size)
+
+def form_bucket(lengths, batch_size, bucket_width):
+    buckets = {}
+    batches = []
+    for length in lengths:
+        bucket = buckets.setdefault(int(length - 1) // bucket_width, [])
+        bucket.append(length)
+        if len(bucket) == batch_size:
+            batches.append(np.array(bucket, 'int32'))
+            bucket.clear()
+    # Flush partially filled buckets, shortest first.
+    for _, bucket in sorted(buckets.items()):
+        if bucket: batches.append(np.array(bucket, 'int32'))
+    return batches
+
+def form_tokens(lengths, batch_size, max_tokens):
+    batches = []
+    batch = []
+    batch_max = 0
+    for length in lengths:
+        new_max = max(batch_max, length)
+        if batch and (new_max * (len(batch) + 1) > max_tokens or len(batch) == batch_size):
+            batches.append(np.array(batch, 'int32'))
+            batch, new_max = [], length
+        batch.append(length)
+        batch_max = new_max
+    if batch: batches.append(np.array(batch, 'int32'))
+    return batches
+
+def form_binpack(lengths, batch_size, max_len):
+    rows = []
+    for length in sorted(lengths, reverse=True):
+        assert length <= max_len, "Sequence of length %d does not fit in a row of %d" % (length, max_len)
+        for i in range(len(rows)):
+            if rows[i] + length <= max_len:
+                rows[i] += length
+                break
+        else:
+            rows.append(length)
+    return chunk(rows, batch_size)
+
+def form_batches(lengths, policy, batch_size, max_tokens=None, max_len=None, bucket_width=32):
+    lengths = [int(length) for length in lengths]
+    if policy == 'fifo': return form_fifo(lengths, batch_size)
+    elif policy == 'bucket': return form_bucket(lengths, batch_size, bucket_width)
+    elif policy == 'tokens':
+        if max_tokens is None: raise ValueError("The tokens policy needs max_tokens")
+        return form_tokens(lengths, batch_size, max_tokens)
+    elif policy == 'binpack':
+        if max_len is None: raise ValueError("The binpack policy needs max_len")
+        return form_binpack(lengths, batch_size, max_len)
+    else: raise ValueError("Unknown batching policy " + policy)
+
+def padding_efficiency(batches):
+    """Fraction of computed tokens that are real when batches are padded to their longest sequence."""
+    real = sum(int(np.sum(batch)) for batch in batches)
+    padded = sum(len(batch) * int(np.amax(batch)) for batch in batches if len(batch) > 0)
+    return real / padded if padded else 1.0
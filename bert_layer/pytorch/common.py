@@ -0,0 +1,68 @@
+import time
+import numpy as np
+import torch
+import torch.utils.benchmark as benchmark
+
+MASK_CACHE_SIZE = 64
+mask_cache = {}
+
+def build_attn_mask(lens, max_len, device, causal=False):
+    # Additive mask of shape (batch_size, max_len, max_len). Rows past a
+    # sequence's length are fully masked. Other rows mask either the
+    # padded columns or, when causal, every column after the row.
+    lens = torch.as_tensor(np.asarray(lens, dtype='int64'), device=device).view(-1, 1, 1)
+    rows = torch.arange(max_len, device=device).view(1, -1, 1)
+    cols = torch.arange(max_len, device=device).view(1, 1, -1)
+    if causal: masked = (rows >= lens) | (cols > rows)
+    else: masked = (rows >= lens) | (cols >= lens)
+    attn_mask = torch.zeros(masked.shape, device=device, dtype=torch.float32)
+    return attn_mask.masked_fill_(masked, -float('inf'))
+
+def get_attn_mask(lens, max_len, device, causal=False):
+    key = (np.asarray(lens, dtype='int32').tobytes(), max_len, str(device), causal)
+    if key not in mask_cache:
+        if len(mask_cache) >= MASK_CACHE_SIZE: mask_cache.clear()
+        mask_cache[key] = build_attn_mask(lens, max_len, device, causal)
+    return mask_cache[key]
+
+def packed_attention(q, k, v, lens, causal=False):
+    # q, k and v hold the tokens of all sequences back to back, with shape
+    # (sum(lens), num_heads, head_size), and so does the result. Nothing
+    # is padded or masked.
+    lens = [int(length) for length in lens]
+    if not causal:
+        def nest(t): return torch.nested.as_nested_tensor(list(t.split(lens)), layout=torch.jagged).transpose(1, 2)
+        return torch.nn.functional.scaled_dot_product_attention(nest(q), nest(k), nest(v)).transpose(1, 2).values()
+    # Not every build supports causal attention on jagged nested tensors,
+    # so causal attention runs per sequence.
+    outs = [torch.nn.functional.scaled_dot_product_attention(qs.transpose(0, 1), ks.transpose(0, 1), vs.transpose(0, 1),
+                                                             is_causal=True).transpose(0, 1)
+            for qs, ks, vs in zip(q.split(lens), k.split(lens), v.split(lens))]
+    return torch.cat(outs)
+
+def sync():
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+
+def time_iters(f, inputs, iters, num_threads=1):
+    """Time iters calls of f(*inputs).
+
+    Returns the mean time in ms of benchmark.Timer.timeit(iters), which
+    runs the calls back to back, and, from a second pass, the time in ms
+    of every call with the device synced around it, for the latency
+    jitter. num_threads is as for benchmark.Timer.
+    """
+    timer = benchmark.Timer(stmt='f(*x)', globals={'x': inputs, 'f': f}, num_threads=num_threads)
+    mean = timer.timeit(iters).mean * 1000.0
+    prev_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        samples = []
+        for i in range(iters):
+            sync()
+            start = time.perf_counter()
+            f(*inputs)
+            sync()
+            samples.append((time.perf_counter() - start) * 1000.0)
+    finally:
+        torch.set_num_threads(prev_threads)
+    return mean, samples
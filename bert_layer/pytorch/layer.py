@@ -11,18 +11,31 @@ import torch.utils.benchmark as benchmark
 import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 import run_utils
+import serving
 import utils
+from common import get_attn_mask, packed_attention, time_iters
+from per_op import OPS, MHA_OPS, OpBreakdown, print_op_times
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--target', nargs='?', default='llvm')
 parser.add_argument('--dtype', dest='dtype', nargs='?', default='float32')
 parser.add_argument('--max-batches', dest='max_batches', default=10, type=int)
 parser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
+parser.add_argument('--max-tokens', dest='max_tokens', default=None, type=int)
 parser.add_argument('--profile', dest='profile', default=False, action='store_true')
 parser.add_argument('--mem', dest='mem', default=False, action='store_true')
 parser.add_argument('--masked-mha', dest='masked_mha', default=False, action='store_true')
+parser.add_argument('--packed', dest='packed', default=False, action='store_true')
+parser.add_argument('--per-op', dest='per_op', default=False, action='store_true')
 parser.add_argument('--debug', dest='debug', default=False, action='store_true')
 parser.add_argument('--dataset', nargs='?', default='random_384_512')
+parser.add_argument('--serve', dest='serve', default=False, action='store_true')
+parser.add_argument('--arrival-rates', dest='arrival_rates', nargs='+', default=[100.0], type=float)
+parser.add_argument('--arrival-trace', dest='arrival_trace', nargs='?', default=None)
+parser.add_argument('--num-requests', dest='num_requests', default=1000, type=int)
+parser.add_argument('--batch-window', dest='batch_window', default=5.0, type=float)
+parser.add_argument('--slo', dest='slo', default=None, type=float)
+parser.add_argument('--worker', dest='worker', default=False, action='store_true')
 args = parser.parse_args()
 
 np.random.seed(0)
@@ -42,8 +55,10 @@ def get_np_tensor(size, device, random, fill_value = None):
         np_array = np.full(size, 0.1, 'float32').astype('float32')
     return torch.from_numpy(np_array).to(device)
 
+# The modules take the batch size and max length from their inputs, so a
+# single scripted instance, with one set of weights, serves every batch.
 class Encoder(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size, ff_size, debug):
+    def __init__(self, device, num_heads, head_size, model_size, ff_size, debug):
         super(Encoder, self).__init__()
         self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, not debug, VAL)
         self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, not debug, VAL)
@@ -53,27 +68,26 @@ class Encoder(nn.Module):
         self.ff2_w = get_np_tensor((ff_size, model_size), device, not debug, VAL)
         self.ff1_b = get_np_tensor((ff_size,), device, not debug, VAL)
         self.ff2_b = get_np_tensor((model_size,), device, not debug, VAL)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
         self.ff_size = ff_size
-        self.max_len = max_len
         self.layer_norm1 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
         self.layer_norm2 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
 
     def forward(self, inp, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         qkv = torch.matmul(inp, self.pre_linear_w)
         qkv += self.pre_linear_b
-        qkv = qkv.view(3, self.num_heads, self.batch_size, self.max_len, self.head_size)
+        qkv = qkv.view(3, self.num_heads, batch_size, max_len, self.head_size)
         q, k, v = torch.split(qkv, 1, 0)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         sa_out = torch.matmul(attn, self.post_linear_w)
         sa_out += self.post_linear_b
-        sa_out += inp.view(self.batch_size, self.max_len, self.model_size)
+        sa_out += inp.view(batch_size, max_len, self.model_size)
         sa_out = self.layer_norm1(sa_out)
 
         ff1_out = torch.matmul(sa_out, self.ff1_w)
@@ -86,90 +100,171 @@ class Encoder(nn.Module):
         return ff_out
 
 class MaskedMHA(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size):
+    def __init__(self, device, num_heads, head_size, model_size):
         super(MaskedMHA, self).__init__()
         self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, True)
         self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, True)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
-        self.max_len = max_len
 
     def forward(self, q, k, v, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         return attn
 
-num_heads = 8
-head_size = 64
-ff_size = 2048
-model_size = num_heads * head_size
-device = torch.device('cuda')
-batch_size = args.batch_size
+# Padding free counterparts of the modules above. They take the tokens of
+# all sequences of a batch back to back and the sequence lengths. Nested
+# tensors cannot be scripted, so these run eagerly.
+class PackedEncoder(nn.Module):
+    def __init__(self, device, num_heads, head_size, model_size, ff_size, debug):
+        super(PackedEncoder, self).__init__()
+        self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, not debug, VAL)
+        self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, not debug, VAL)
+        self.post_linear_w = get_np_tensor((model_size, model_size), device, not debug, VAL)
+        self.post_linear_b = get_np_tensor((model_size,), device, not debug, VAL)
+        self.ff1_w = get_np_tensor((model_size, ff_size), device, not debug, VAL)
+        self.ff2_w = get_np_tensor((ff_size, model_size), device, not debug, VAL)
+        self.ff1_b = get_np_tensor((ff_size,), device, not debug, VAL)
+        self.ff2_b = get_np_tensor((model_size,), device, not debug, VAL)
+        self.model_size = model_size
+        self.layer_norm1 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
+        self.layer_norm2 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
 
-batches = run_utils.get_nlp_batches(batch_size, args.max_batches, args.dataset)
+    def forward(self, inp, lens):
+        qkv = torch.matmul(inp, self.pre_linear_w)
+        qkv += self.pre_linear_b
+        q, k, v = qkv.permute(0, 2, 1, 3)
+        attn = packed_attention(q, k, v, lens).reshape(-1, self.model_size)
+        sa_out = torch.matmul(attn, self.post_linear_w)
+        sa_out += self.post_linear_b
+        sa_out += inp
+        sa_out = self.layer_norm1(sa_out)
 
-iters = 1 if args.mem or args.debug else 100
+        ff1_out = torch.matmul(sa_out, self.ff1_w)
+        ff1_out += self.ff1_b
+        ff1_out = f.relu(ff1_out)
+        ff2_out = torch.matmul(ff1_out, self.ff2_w)
+        ff2_out += self.ff2_b
+        ff2_out += sa_out
+        ff_out = self.layer_norm2(ff2_out)
+        return ff_out
+
+class PackedMaskedMHA(nn.Module):
+    def __init__(self, device, num_heads, head_size, model_size):
+        super(PackedMaskedMHA, self).__init__()
+        self.model_size = model_size
+
+    def forward(self, q, k, v, lens):
+        return packed_attention(q, k, v, lens, causal=True).reshape(-1, self.model_size)
+
+def main(args):
+    # Peak memory is tracked per configuration, also when serving several.
+    if args.mem: torch.cuda.reset_peak_memory_stats()
 
-callable_to_profile = None
-def run_for_batches():
-    batch_times = []
-    for batch in batches:
+    num_heads = 8
+    head_size = 64
+    ff_size = 2048
+    model_size = num_heads * head_size
+    device = torch.device('cuda')
+
+    if args.serve:
+        # Requests are single sequences, batched by the simulated server.
+        batches = run_utils.get_nlp_batches(args.num_requests, 1, args.dataset)
+    elif args.max_tokens:
+        batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset,
+                                            policy='tokens', max_tokens=args.max_tokens)
+    else:
+        batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset)
+
+    iters = 1 if args.mem or args.debug else 100
+
+    callable_to_profile = None
+    if args.packed:
+        if args.masked_mha: traced_encoder = PackedMaskedMHA(device, num_heads, head_size, model_size)
+        else: traced_encoder = PackedEncoder(device, num_heads, head_size, model_size, ff_size, args.debug)
+    else:
+        if args.masked_mha: encoder = MaskedMHA(device, num_heads, head_size, model_size)
+        else: encoder = Encoder(device, num_heads, head_size, model_size, ff_size, args.debug)
+        traced_encoder = torch.jit.script(encoder)
+
+    def run_batch(batch):
+        batch_size = len(batch)
         max_len = int(np.amax(batch))
 
-        attn_mask = np.full((batch_size, max_len, max_len), 0.0, dtype='float32')
-        if args.masked_mha:
-            for i in range(batch_size):
-                for j in range(max_len):
-                    if j >= batch[i]:
-                        for k in range(0, max_len):
-                            attn_mask[i][j][k] = -float('inf')
-                    else:
-                        for k in range(j + 1, max_len):
-                            attn_mask[i][j][k] = -float('inf')
-            attn_mask = torch.from_numpy(attn_mask).to(device)
-            encoder = MaskedMHA(device, max_len, batch_size, num_heads, head_size, model_size)
-            traced_encoder = torch.jit.script(encoder)
-            q = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-            k = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-            v = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-            timer = benchmark.Timer(stmt='f(q, k, v, y)',
-                                    globals={'q': q, 'k': k, 'v': v,
-                                             'y': attn_mask, 'f': traced_encoder})
+        if args.packed:
+            lens = [int(length) for length in batch]
+            num_tokens = sum(lens)
+            if args.masked_mha:
+                q = get_np_tensor((num_tokens, num_heads, head_size), device, True)
+                k = get_np_tensor((num_tokens, num_heads, head_size), device, True)
+                v = get_np_tensor((num_tokens, num_heads, head_size), device, True)
+                inputs = [q, k, v, lens]
+            else:
+                inp = get_np_tensor((num_tokens, model_size), device, True)
+                inputs = [inp, lens]
+        elif args.masked_mha:
+            attn_mask = get_attn_mask(batch, max_len, device, causal=True)
+            q = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            k = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            v = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            inputs = [q, k, v, attn_mask]
         else:
-            for i in range(batch_size):
-                for j in range(max_len):
-                    if j >= batch[i]:
-                        for k in range(0, max_len):
-                            attn_mask[i][j][k] = -float('inf')
-                    else:
-                        for k in range(batch[i], max_len):
-                            attn_mask[i][j][k] = -float('inf')
-            attn_mask = torch.from_numpy(attn_mask).to(device)
-            encoder = Encoder(device, max_len, batch_size, num_heads, head_size, model_size, ff_size, args.debug)
-            traced_encoder = torch.jit.script(encoder)
-
-            inp = get_np_tensor((args.batch_size * max_len, model_size), device, True)
-            timer = benchmark.Timer(stmt='f(x, y)',
-                                    globals={'x': inp, 'y': attn_mask, 'f': traced_encoder})
-
-        batch_times.append(timer.timeit(iters).mean * 1000.0)
-
-    return batch_times
-
-with torch.no_grad():
-    if not args.profile:
-        batch_times = run_for_batches()
-        print('RESULTS', sum(batch_times) / len(batches), sep=',')
-    else:
-        with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
-            run_for_batches()
-            print(prof.key_averages(group_by_stack_n=5))
-
-if args.mem:
-    if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
-    max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
-    print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+            attn_mask = get_attn_mask(batch, max_len, device)
+            inp = get_np_tensor((batch_size * max_len, model_size), device, True)
+            inputs = [inp, attn_mask]
+
+        # The mean time in ms and the time of every iteration, see time_iters.
+        return time_iters(traced_encoder, inputs, iters)
+
+    def run_for_batches():
+        return [run_batch(batch) for batch in batches]
+
+    def serve():
+        lengths = np.concatenate(batches)[:args.num_requests]
+        service_times = {}
+        def service_time(batch):
+            # Batches of the same lengths recur across loads, time them once.
+            key = batch.tobytes()
+            if key not in service_times: service_times[key] = run_batch(batch)[0] / 1000.0
+            return service_times[key]
+
+        for rate in args.arrival_rates:
+            if args.arrival_trace: arrivals = serving.trace_arrivals(args.arrival_trace, len(lengths), rate)
+            else: arrivals = serving.poisson_arrivals(len(lengths), rate)
+            finish = serving.simulate(lengths, arrivals, service_time, args.batch_size, args.batch_window / 1000.0,
+                                      max_tokens=args.max_tokens)
+            summary = serving.summarize(arrivals, finish, slo=args.slo)
+            print('SERVE', rate, summary['p50'], summary['p95'], summary['p99'], summary['throughput'],
+                  summary['goodput'], sep=',')
+            run_utils.print_record((finish - arrivals) * 1000.0, args, name='serve', arrival_rate=rate, **summary)
+
+    with torch.no_grad():
+        if args.serve:
+            serve()
+        elif args.per_op:
+            breakdown = OpBreakdown(device, ops=MHA_OPS if args.masked_mha else OPS, causal=args.masked_mha)
+            print_op_times(breakdown.run(batches, iters), args, iters)
+        elif not args.profile:
+            batch_results = run_for_batches()
+            batch_times = [mean for mean, samples in batch_results]
+            all_samples = [t for mean, samples in batch_results for t in samples]
+            print('RESULTS', sum(batch_times) / len(batches), sep=',')
+            throughput = run_utils.print_throughput(batches, batch_times)
+            run_utils.print_record(all_samples, args, warmup=max(iters // 100, 2), iters=iters,
+                                   tokens_per_s=throughput, batch_means=batch_times)
+        else:
+            with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
+                run_for_batches()
+                print(prof.key_averages(group_by_stack_n=5))
+
+    if args.mem:
+        if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
+        max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
+        print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+
+if args.worker: run_utils.serve_worker(parser, main)
+else: main(args)
@@ -12,6 +12,7 @@ import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 import run_utils
 import utils
+from common import packed_attention, time_iters
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--target', nargs='?', default='llvm')
@@ -21,8 +22,11 @@ parser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
 parser.add_argument('--profile', dest='profile', default=False, action='store_true')
 parser.add_argument('--mem', dest='mem', default=False, action='store_true')
 parser.add_argument('--masked-mha', dest='masked_mha', default=False, action='store_true')
+parser.add_argument('--packed', dest='packed', default=False, action='store_true')
 parser.add_argument('--debug', dest='debug', default=False, action='store_true')
 parser.add_argument('--dataset', nargs='?', default='random_384_512')
+parser.add_argument('--threads', dest='threads', default=None, type=int)
+parser.add_argument('--worker', dest='worker', default=False, action='store_true')
 args = parser.parse_args()
 
 np.random.seed(0)
@@ -44,8 +48,10 @@ def get_np_tensor(size, device, random, fill_value = None):
 
 def mean(l): return sum(l) / len(l)
 
+# The modules take the batch size and max length from their inputs, so a
+# single scripted instance, with one set of weights, serves every batch.
 class Encoder(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size, ff_size, debug):
+    def __init__(self, device, num_heads, head_size, model_size, ff_size, debug):
         super(Encoder, self).__init__()
         self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, not debug, VAL)
         self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, not debug, VAL)
@@ -55,27 +61,26 @@ class Encoder(nn.Module):
         self.ff2_w = get_np_tensor((ff_size, model_size), device, not debug, VAL)
         self.ff1_b = get_np_tensor((ff_size,), device, not debug, VAL)
         self.ff2_b = get_np_tensor((model_size,), device, not debug, VAL)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
         self.ff_size = ff_size
-        self.max_len = max_len
         self.layer_norm1 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
         self.layer_norm2 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
 
     def forward(self, inp, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         qkv = torch.matmul(inp, self.pre_linear_w)
         qkv += self.pre_linear_b
-        qkv = qkv.view(3, self.num_heads, self.batch_size, self.max_len, self.head_size)
+        qkv = qkv.view(3, self.num_heads, batch_size, max_len, self.head_size)
         q, k, v = torch.split(qkv, 1, 0)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         sa_out = torch.matmul(attn, self.post_linear_w)
         sa_out += self.post_linear_b
-        sa_out += inp.view(self.batch_size, self.max_len, self.model_size)
+        sa_out += inp.view(batch_size, max_len, self.model_size)
         sa_out = self.layer_norm1(sa_out)
 
         ff1_out = torch.matmul(sa_out, self.ff1_w)
@@ -88,101 +93,170 @@ class Encoder(nn.Module):
         return ff_out
 
 class MaskedMHA(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size):
+    def __init__(self, device, num_heads, head_size, model_size):
         super(MaskedMHA, self).__init__()
         self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, True)
         self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, True)
         self.post_linear_w = get_np_tensor((model_size, model_size), device, True, VAL)
         self.post_linear_b = get_np_tensor((model_size,), device, True, VAL)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
-        self.max_len = max_len
-        self.qkt = get_np_tensor((1, num_heads, batch_size, max_len, max_len), device, True, VAL)
-
 
     def forward(self, inp, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         qkv = torch.matmul(inp, self.pre_linear_w)
         qkv += self.pre_linear_b
-        qkv = qkv.view(3, self.num_heads, self.batch_size, self.max_len, self.head_size)
+        qkv = qkv.view(3, self.num_heads, batch_size, max_len, self.head_size)
         q, k, v = torch.split(qkv, 1, 0)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         sa_out = torch.matmul(attn, self.post_linear_w)
         sa_out += self.post_linear_b
         return sa_out
 
-num_heads = 8
-head_size = 64
-ff_size = 2048
-model_size = num_heads * head_size
-device = torch.device('cpu')
-batch_size = args.batch_size
-
-batches = run_utils.get_nlp_batches(batch_size, args.max_batches, args.dataset)
-
-iters = 1 if args.mem or args.debug else 20
-
-callable_to_profile = None
-torch.set_num_threads(8)
-def run_for_batches():
-    batch_times = []
-    for batch in batches:
-        max_len = int(np.amax(batch))
-
-        attn_mask = np.full((batch_size, max_len, max_len), 0.0, dtype='float32')
-        if args.masked_mha:
-            # for i in range(batch_size):
-                # for j in range(max_len):
-                    # if j >= batch[i]:
-                        # for k in range(0, max_len):
-                            # attn_mask[i][j][k] = -float('inf')
-                    # else:
-                        # for k in range(j + 1, max_len):
-                            # attn_mask[i][j][k] = -float('inf')
-            attn_mask = torch.from_numpy(attn_mask).to(device)
-            encoder = MaskedMHA(device, max_len, batch_size, num_heads, head_size, model_size)
-            traced_encoder = torch.jit.script(encoder)
-            inp = get_np_tensor((args.batch_size * max_len, model_size), device, True)
-        else:
-            # for i in range(batch_size):
-                # for j in range(max_len):
-                    # if j >= batch[i]:
-                        # for k in range(0, max_len):
-                            # attn_mask[i][j][k] = -float('inf')
-                    # else:
-                        # for k in range(batch[i], max_len):
-                            # attn_mask[i][j][k] = -float('inf')
-            attn_mask = torch.from_numpy(attn_mask).to(device)
-            encoder = Encoder(device, max_len, batch_size, num_heads, head_size, model_size, ff_size, args.debug)
-
-        if args.debug:
-            inp = get_np_tensor((args.batch_size * max_len, model_size), device, True)
-            ret = encoder.forward(inp, attn_mask)
-            print(np.mean(ret.cpu().numpy()))
-        else:
-            traced_encoder = torch.jit.script(encoder)
-            inp = get_np_tensor((args.batch_size * max_len, model_size), device, True)
-            timer = benchmark.Timer(stmt='f(x, y)',
-                                    globals={'x': inp, 'y': attn_mask, 'f': traced_encoder},
-                                    num_threads=8)
-            batch_times.append(timer.timeit(iters).mean * 1000.0)
-
-    return batch_times
-
-with torch.no_grad():
-    if not args.profile:
-        batch_times = run_for_batches()
-        print('RESULTS', sum(batch_times) / len(batches), sep=',')
+# Padding free counterparts of the modules above. They take the tokens of
+# all sequences of a batch back to back and the sequence lengths. Nested
+# tensors cannot be scripted, so these run eagerly.
+class PackedEncoder(nn.Module):
+    def __init__(self, device, num_heads, head_size, model_size, ff_size, debug):
+        super(PackedEncoder, self).__init__()
+        self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, not debug, VAL)
+        self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, not debug, VAL)
+        self.post_linear_w = get_np_tensor((model_size, model_size), device, not debug, VAL)
+        self.post_linear_b = get_np_tensor((model_size,), device, not debug, VAL)
+        self.ff1_w = get_np_tensor((model_size, ff_size), device, not debug, VAL)
+        self.ff2_w = get_np_tensor((ff_size, model_size), device, not debug, VAL)
+        self.ff1_b = get_np_tensor((ff_size,), device, not debug, VAL)
+        self.ff2_b = get_np_tensor((model_size,), device, not debug, VAL)
+        self.model_size = model_size
+        self.layer_norm1 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
+        self.layer_norm2 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
+
+    def forward(self, inp, lens):
+        qkv = torch.matmul(inp, self.pre_linear_w)
+        qkv += self.pre_linear_b
+        q, k, v = qkv.permute(0, 2, 1, 3)
+        attn = packed_attention(q, k, v, lens).reshape(-1, self.model_size)
+        sa_out = torch.matmul(attn, self.post_linear_w)
+        sa_out += self.post_linear_b
+        sa_out += inp
+        sa_out = self.layer_norm1(sa_out)
+
+        ff1_out = torch.matmul(sa_out, self.ff1_w)
+        ff1_out += self.ff1_b
+        ff1_out = f.gelu(ff1_out)
+        ff2_out = torch.matmul(ff1_out, self.ff2_w)
+        ff2_out += self.ff2_b
+        ff2_out += sa_out
+        ff_out = self.layer_norm2(ff2_out)
+        return ff_out
+
+class PackedMaskedMHA(nn.Module):
+    def __init__(self, device, num_heads, head_size, model_size):
+        super(PackedMaskedMHA, self).__init__()
+        self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, True)
+        self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, True)
+        self.post_linear_w = get_np_tensor((model_size, model_size), device, True, VAL)
+        self.post_linear_b = get_np_tensor((model_size,), device, True, VAL)
+        self.model_size = model_size
+
+    def forward(self, inp, lens):
+        qkv = torch.matmul(inp, self.pre_linear_w)
+        qkv += self.pre_linear_b
+        q, k, v = qkv.permute(0, 2, 1, 3)
+        attn = packed_attention(q, k, v, lens, causal=True).reshape(-1, self.model_size)
+        sa_out = torch.matmul(attn, self.post_linear_w)
+        sa_out += self.post_linear_b
+        return sa_out
+
+def main(args):
+    num_heads = 8
+    head_size = 64
+    ff_size = 2048
+    model_size = num_heads * head_size
+    device = torch.device('cpu')
+    batch_size = args.batch_size
+
+    batches = run_utils.get_nlp_batches(batch_size, args.max_batches, args.dataset)
+
+    iters = 1 if args.mem or args.debug else 20
+
+    callable_to_profile = None
+    num_threads = run_utils.get_num_threads(args.threads)
+    torch.set_num_threads(num_threads)
+    if args.packed:
+        if args.masked_mha: encoder = PackedMaskedMHA(device, num_heads, head_size, model_size)
+        else: encoder = PackedEncoder(device, num_heads, head_size, model_size, ff_size, args.debug)
+        traced_encoder = encoder
     else:
-        with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
-            run_for_batches()
-            print(prof.key_averages(group_by_stack_n=5))
-
-if args.mem:
-    if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
-    max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
-    print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+        if args.masked_mha: encoder = MaskedMHA(device, num_heads, head_size, model_size)
+        else: encoder = Encoder(device, num_heads, head_size, model_size, ff_size, args.debug)
+        traced_encoder = torch.jit.script(encoder)
+
+    def run_for_batches():
+        # The mean time in ms and the time of every iteration of every
+        # batch, see time_iters.
+        batch_results = []
+        for batch in batches:
+            max_len = int(np.amax(batch))
+
+            attn_mask = np.full((batch_size, max_len, max_len), 0.0, dtype='float32')
+            if args.masked_mha:
+                # for i in range(batch_size):
+                    # for j in range(max_len):
+                        # if j >= batch[i]:
+                            # for k in range(0, max_len):
+                                # attn_mask[i][j][k] = -float('inf')
+                        # else:
+                            # for k in range(j + 1, max_len):
+                                # attn_mask[i][j][k] = -float('inf')
+                attn_mask = torch.from_numpy(attn_mask).to(device)
+            else:
+                # for i in range(batch_size):
+                    # for j in range(max_len):
+                        # if j >= batch[i]:
+                            # for k in range(0, max_len):
+                                # attn_mask[i][j][k] = -float('inf')
+                        # else:
+                            # for k in range(batch[i], max_len):
+                                # attn_mask[i][j][k] = -float('inf')
+                attn_mask = torch.from_numpy(attn_mask).to(device)
+
+            y, num_tokens = attn_mask, args.batch_size * max_len
+            if args.packed:
+                # The packed modules take the lengths instead of a mask.
+                y, num_tokens = [int(length) for length in batch], int(np.sum(batch))
+
+            if args.debug:
+                inp = get_np_tensor((num_tokens, model_size), device, True)
+                ret = encoder.forward(inp, y)
+                print(np.mean(ret.cpu().numpy()))
+            else:
+                inp = get_np_tensor((num_tokens, model_size), device, True)
+                batch_results.append(time_iters(traced_encoder, [inp, y], iters, num_threads=num_threads))
+
+        return batch_results
+
+    with torch.no_grad():
+        if not args.profile:
+            batch_results = run_for_batches()
+            batch_times = [mean for mean, samples in batch_results]
+            all_samples = [t for mean, samples in batch_results for t in samples]
+            print('RESULTS', sum(batch_times) / len(batches), sep=',')
+            run_utils.print_record(all_samples, args, warmup=max(iters // 100, 2), iters=iters,
+                                   batch_means=batch_times)
+        else:
+            with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
+                run_for_batches()
+                print(prof.key_averages(group_by_stack_n=5))
+
+    if args.mem:
+        if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
+        max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
+        print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+
+if args.worker: run_utils.serve_worker(parser, main)
+else: main(args)
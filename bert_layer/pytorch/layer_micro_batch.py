@@ -7,11 +7,12 @@ import torch.nn.functional as f
 from torch.profiler import profile, record_function, ProfilerActivity
 from torch import Tensor
 from torch import nn
-import torch.utils.benchmark as benchmark
 import sys
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 import run_utils
 import utils
+from common import get_attn_mask, time_iters
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--target', nargs='?', default='llvm')
@@ -19,11 +20,13 @@ parser.add_argument('--dtype', dest='dtype', nargs='?', default='float32')
 parser.add_argument('--max-batches', dest='max_batches', default=10, type=int)
 parser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
 parser.add_argument('--micro-batch-size', dest='micro_batch_size', default=32, type=int)
+parser.add_argument('--concurrency', nargs='?', default='serial', choices=['serial', 'streams', 'threads'])
 parser.add_argument('--profile', dest='profile', default=False, action='store_true')
 parser.add_argument('--mem', dest='mem', default=False, action='store_true')
 parser.add_argument('--masked-mha', dest='masked_mha', default=False, action='store_true')
 parser.add_argument('--debug', dest='debug', default=False, action='store_true')
 parser.add_argument('--dataset', nargs='?', default='random_384_512')
+parser.add_argument('--worker', dest='worker', default=False, action='store_true')
 args = parser.parse_args()
 
 np.random.seed(0)
@@ -43,8 +46,10 @@ def get_np_tensor(size, device, random, fill_value = None):
         np_array = np.full(size, 0.1, 'float32').astype('float32')
     return torch.from_numpy(np_array).to(device)
 
+# The modules take the batch size and max length from their inputs, so a
+# single scripted instance serves micro-batches of every shape.
 class Encoder(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size, ff_size, debug):
+    def __init__(self, device, num_heads, head_size, model_size, ff_size, debug):
         super(Encoder, self).__init__()
         self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, not debug, VAL)
         self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, not debug, VAL)
@@ -54,27 +59,26 @@ class Encoder(nn.Module):
         self.ff2_w = get_np_tensor((ff_size, model_size), device, not debug, VAL)
         self.ff1_b = get_np_tensor((ff_size,), device, not debug, VAL)
         self.ff2_b = get_np_tensor((model_size,), device, not debug, VAL)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
         self.ff_size = ff_size
-        self.max_len = max_len
         self.layer_norm1 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
         self.layer_norm2 = torch.nn.LayerNorm((self.model_size,), elementwise_affine=not debug, device=device)
 
     def forward(self, inp, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         qkv = torch.matmul(inp, self.pre_linear_w)
         qkv += self.pre_linear_b
-        qkv = qkv.view(3, self.num_heads, self.batch_size, self.max_len, self.head_size)
+        qkv = qkv.view(3, self.num_heads, batch_size, max_len, self.head_size)
         q, k, v = torch.split(qkv, 1, 0)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         sa_out = torch.matmul(attn, self.post_linear_w)
         sa_out += self.post_linear_b
-        sa_out += inp.view(self.batch_size, self.max_len, self.model_size)
+        sa_out += inp.view(batch_size, max_len, self.model_size)
         sa_out = self.layer_norm1(sa_out)
 
         ff1_out = torch.matmul(sa_out, self.ff1_w)
@@ -87,101 +91,130 @@ class Encoder(nn.Module):
         return ff_out
 
 class MaskedMHA(nn.Module):
-    def __init__(self, device, max_len, batch_size, num_heads, head_size, model_size):
+    def __init__(self, device, num_heads, head_size, model_size):
         super(MaskedMHA, self).__init__()
-        self.pre_linear_w = get_np_tensor((3, num_heads, model_size, head_size), device, True)
-        self.pre_linear_b = get_np_tensor((3, num_heads, 1, head_size), device, True)
-        self.batch_size = batch_size
         self.num_heads = num_heads
         self.head_size = head_size
         self.model_size = model_size
-        self.max_len = max_len
 
     def forward(self, q, k, v, attn_mask):
+        batch_size, max_len = attn_mask.size(0), attn_mask.size(1)
         attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
         attn += attn_mask
         attn = f.softmax(attn, dim = 4)
-        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (self.batch_size, self.max_len, self.model_size))
+        attn = torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
         return attn
 
-num_heads = 8
-head_size = 64
-ff_size = 2048
-model_size = num_heads * head_size
-device = torch.device('cuda')
-batch_size = args.batch_size
-
-batches = run_utils.get_nlp_batches(batch_size, args.max_batches, args.dataset)
-
-iters = 1 if args.mem or args.debug else 100
-
-callable_to_profile = None
-
-def run_for_a_batch(batch):
-    max_len = int(np.amax(batch))
-
-    attn_mask = np.full((batch_size, max_len, max_len), 0.0, dtype='float32')
-    if args.masked_mha:
-        for i in range(batch_size):
-            for j in range(max_len):
-                if j >= batch[i]:
-                    for k in range(0, max_len):
-                        attn_mask[i][j][k] = -float('inf')
-                else:
-                    for k in range(j + 1, max_len):
-                        attn_mask[i][j][k] = -float('inf')
-        attn_mask = torch.from_numpy(attn_mask).to(device)
-        encoder = MaskedMHA(device, max_len, batch_size, num_heads, head_size, model_size)
-        traced_encoder = torch.jit.script(encoder)
-        q = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-        k = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-        v = get_np_tensor((1, num_heads, args.batch_size, max_len, head_size), device, True)
-        timer = benchmark.Timer(stmt='f(q, k, v, y)',
-                                globals={'q': q, 'k': k, 'v': v,
-                                         'y': attn_mask, 'f': traced_encoder})
-    else:
-        # for i in range(batch_size):
-        #     for j in range(max_len):
-        #         if j >= batch[i]:
-        #             for k in range(0, max_len):
-        #                 attn_mask[i][j][k] = -float('inf')
-        #         else:
-        #             for k in range(batch[i], max_len):
-        #                 attn_mask[i][j][k] = -float('inf')
-        attn_mask = torch.from_numpy(attn_mask).to(device)
-        encoder = Encoder(device, max_len, batch_size, num_heads, head_size, model_size, ff_size, args.debug)
-        traced_encoder = torch.jit.script(encoder)
-
-        inp = get_np_tensor((args.batch_size * max_len, model_size), device, True)
-        timer = benchmark.Timer(stmt='f(x, y)',
-                                globals={'x': inp, 'y': attn_mask, 'f': traced_encoder})
-        return timer.timeit(iters).mean * 1000.0
-
-def run_for_batches():
-    batch_times = []
-    for batch in batches:
-        batch = np.sort(batch)
-        bs = batch_size
-        ubs = args.micro_batch_size
-
-        batch_time = 0
-        micro_batches = np.split(batch, bs // ubs)
-        for micro_batch in micro_batches:
-            batch_time += run_for_a_batch(micro_batch)
-        batch_times.append(batch_time)
-
-    return batch_times
-
-with torch.no_grad():
-    if not args.profile:
-        batch_times = run_for_batches()
-        print('RESULTS', sum(batch_times) / len(batches), sep=',')
-    else:
-        with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
-            run_for_batches()
-            print(prof.key_averages(group_by_stack_n=5))
-
-if args.mem:
-    if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
-    max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
-    print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+# Micro-batching is the padding-only alternative to ragged kernels: a
+# batch is sorted by length and cut into micro-batches, each padded only
+# to its own max length, so short sequences no longer pay for the longest
+# one. Every batch is also run whole, padded to its max length, and the
+# runner reports both times and how much of the padding the split saved.
+# With --concurrency the micro-batches of a batch run on their own CUDA
+# streams or host threads instead of one after the other.
+
+def split_micro_batches(batch, micro_batch_size):
+    batch = np.sort(batch)
+    return [batch[i:i + micro_batch_size] for i in range(0, len(batch), micro_batch_size)]
+
+def get_padded_tokens(micro_batches):
+    return sum(len(micro_batch) * int(np.amax(micro_batch)) for micro_batch in micro_batches)
+
+def main(args):
+    num_heads = 8
+    head_size = 64
+    ff_size = 2048
+    model_size = num_heads * head_size
+    device = torch.device('cuda' if args.target == 'cuda' else 'cpu')
+    if args.concurrency == 'streams' and device.type != 'cuda':
+        raise ValueError("Stream concurrency only supported for GPUs")
+
+    batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset)
+    iters = 1 if args.mem or args.debug else 100
+
+    if args.masked_mha: encoder = MaskedMHA(device, num_heads, head_size, model_size)
+    else: encoder = Encoder(device, num_heads, head_size, model_size, ff_size, args.debug)
+    traced_encoder = torch.jit.script(encoder)
+
+    max_micro_batches = (args.batch_size + args.micro_batch_size - 1) // args.micro_batch_size
+    streams = [torch.cuda.Stream(device) for i in range(max_micro_batches)] if args.concurrency == 'streams' else None
+    pool = ThreadPoolExecutor(max_micro_batches) if args.concurrency == 'threads' else None
+
+    def get_inputs(batch):
+        batch_size = len(batch)
+        max_len = int(np.amax(batch))
+        if args.masked_mha:
+            attn_mask = get_attn_mask(batch, max_len, device, causal=True)
+            q = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            k = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            v = get_np_tensor((1, num_heads, batch_size, max_len, head_size), device, True)
+            return [q, k, v, attn_mask]
+        else:
+            attn_mask = get_attn_mask(batch, max_len, device)
+            inp = get_np_tensor((batch_size * max_len, model_size), device, True)
+            return [inp, attn_mask]
+
+    def run_serial(all_inputs):
+        for inputs in all_inputs: traced_encoder(*inputs)
+
+    def run_streams(all_inputs):
+        current = torch.cuda.current_stream(device)
+        for stream, inputs in zip(streams, all_inputs):
+            # The inputs were made on the current stream.
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream): traced_encoder(*inputs)
+        for stream in streams[:len(all_inputs)]: current.wait_stream(stream)
+
+    def run_threads(all_inputs):
+        for future in [pool.submit(traced_encoder, *inputs) for inputs in all_inputs]: future.result()
+
+    run_concurrent = {'serial': run_serial, 'streams': run_streams, 'threads': run_threads}[args.concurrency]
+
+    def time_batch(micro_batches, run):
+        # The mean time in ms and the time of every iteration, see time_iters.
+        all_inputs = [get_inputs(micro_batch) for micro_batch in micro_batches]
+        return time_iters(run, [all_inputs], iters)
+
+    def run_for_batches():
+        micro_results, mono_results = [], []
+        for batch in batches:
+            micro_results.append(time_batch(split_micro_batches(batch, args.micro_batch_size), run_concurrent))
+            mono_results.append(time_batch([batch], run_serial))
+        return micro_results, mono_results
+
+    with torch.no_grad():
+        if not args.profile:
+            micro_results, mono_results = run_for_batches()
+            micro_times = [mean for mean, samples in micro_results]
+            mono_times = [mean for mean, samples in mono_results]
+            micro_time = sum(micro_times) / len(batches)
+            mono_time = sum(mono_times) / len(batches)
+
+            tokens = sum(int(np.sum(batch)) for batch in batches)
+            mono_padded = sum(get_padded_tokens([batch]) for batch in batches)
+            micro_padded = sum(get_padded_tokens(split_micro_batches(batch, args.micro_batch_size)) for batch in batches)
+            # Fraction of the monolithic run's padding tokens the split avoids.
+            padding_saved = (mono_padded - micro_padded) / max(mono_padded - tokens, 1)
+
+            print('RESULTS', micro_time, sep=',')
+            print('MICRO_BATCH', mono_time, micro_time, mono_time / micro_time, padding_saved, sep=',')
+            throughput = run_utils.print_throughput(batches, micro_times)
+            run_utils.print_record([t for mean, samples in micro_results for t in samples], args,
+                                   warmup=max(iters // 100, 2), iters=iters, batch_means=micro_times,
+                                   tokens_per_s=throughput, monolithic_ms=mono_time, speedup=mono_time / micro_time,
+                                   padded_tokens=micro_padded, monolithic_padded_tokens=mono_padded,
+                                   padding_saved=padding_saved)
+        else:
+            with profile(activities=[ProfilerActivity.CUDA], record_shapes=True) as prof:
+                run_for_batches()
+                print(prof.key_averages(group_by_stack_n=5))
+
+    if pool is not None: pool.shutdown()
+
+    if args.mem:
+        if args.target != "cuda": raise ValueError("Mem measurement only supported for GPUs")
+        max_buffer_mem_alloced = torch.cuda.max_memory_allocated()
+        print("MEM,%g" % (max_buffer_mem_alloced / (1024.0 * 1024.0)))
+
+if args.worker: run_utils.serve_worker(parser, main)
+else: main(args)
@@ -0,0 +1,174 @@
+import numpy as np
+import torch
+import torch.nn.functional as f
+from torch import nn
+import run_utils
+from common import get_attn_mask, time_iters
+
+# Per op breakdown of the encoder layer for the PyTorch baselines. The ops
+# and their names match masked_mha.py --per-op, so that op_times_eval.py
+# can line up the frameworks op by op. As in the CoRa kernels, the
+# residual adds are part of post_linear and ff2, and norm_add1/norm_add2
+# are the layer norms. Each op is scripted once and timed per batch on
+# random inputs of the batch's padded shape.
+OPS = ['pre_linear', 'qkt', 'softmax', 'attn_v', 'post_linear', 'norm_add1', 'ff1', 'ff2', 'norm_add2']
+MHA_OPS = ['qkt', 'softmax', 'attn_v']
+
+def randn(shape, device):
+    return torch.randn(shape, device=device, requires_grad=False, dtype=torch.float32)
+
+class PreLinear(nn.Module):
+    def __init__(self, device, num_heads, head_size, model_size):
+        super(PreLinear, self).__init__()
+        self.pre_linear_w = randn((3, num_heads, model_size, head_size), device)
+        self.pre_linear_b = randn((3, num_heads, 1, head_size), device)
+        self.num_heads = num_heads
+        self.head_size = head_size
+
+    def forward(self, inp, batch_size: int):
+        max_len = inp.size(0) // batch_size
+        qkv = torch.matmul(inp, self.pre_linear_w)
+        qkv += self.pre_linear_b
+        return qkv.view(3, self.num_heads, batch_size, max_len, self.head_size)
+
+class QKt(nn.Module):
+    def forward(self, q, k, attn_mask):
+        attn = torch.matmul(q, k.permute(0, 1, 2, 4, 3))
+        attn += attn_mask
+        return attn
+
+class Softmax(nn.Module):
+    def forward(self, attn):
+        return f.softmax(attn, dim = 4)
+
+class AttnV(nn.Module):
+    def __init__(self, model_size):
+        super(AttnV, self).__init__()
+        self.model_size = model_size
+
+    def forward(self, attn, v):
+        batch_size, max_len = v.size(2), v.size(3)
+        return torch.reshape(torch.matmul(attn, v).permute(0, 2, 3, 1, 4), (batch_size, max_len, self.model_size))
+
+class PostLinear(nn.Module):
+    def __init__(self, device, model_size):
+        super(PostLinear, self).__init__()
+        self.post_linear_w = randn((model_size, model_size), device)
+        self.post_linear_b = randn((model_size,), device)
+
+    def forward(self, attn, residual):
+        sa_out = torch.matmul(attn, self.post_linear_w)
+        sa_out += self.post_linear_b
+        sa_out += residual
+        return sa_out
+
+class NormAdd(nn.Module):
+    def __init__(self, device, model_size):
+        super(NormAdd, self).__init__()
+        self.layer_norm = torch.nn.LayerNorm((model_size,), device=device)
+
+    def forward(self, inp):
+        return self.layer_norm(inp)
+
+class FF1(nn.Module):
+    def __init__(self, device, model_size, ff_size, gelu: bool):
+        super(FF1, self).__init__()
+        self.ff1_w = randn((model_size, ff_size), device)
+        self.ff1_b = randn((ff_size,), device)
+        self.gelu = gelu
+
+    def forward(self, inp):
+        ff1_out = torch.matmul(inp, self.ff1_w)
+        ff1_out += self.ff1_b
+        if self.gelu: return f.gelu(ff1_out)
+        else: return f.relu(ff1_out)
+
+class FF2(nn.Module):
+    def __init__(self, device, model_size, ff_size):
+        super(FF2, self).__init__()
+        self.ff2_w = randn((ff_size, model_size), device)
+        self.ff2_b = randn((model_size,), device)
+
+    def forward(self, inp, residual):
+        ff2_out = torch.matmul(inp, self.ff2_w)
+        ff2_out += self.ff2_b
+        ff2_out += residual
+        return ff2_out
+
+class OpBreakdown:
+    """Times the ops of one encoder layer separately, batch by batch.
+
+    gelu selects the FF activation, to match the CPU (gelu) or GPU (relu)
+    baseline, and causal the attention mask.
+    """
+    def __init__(self, device, ops=OPS, num_heads=8, head_size=64, ff_size=2048, gelu=False, causal=False,
+                 num_threads=1):
+        self.device = device
+        self.ops = ops
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.model_size = num_heads * head_size
+        self.ff_size = ff_size
+        self.causal = causal
+        self.num_threads = num_threads
+        modules = {
+            'pre_linear': PreLinear(device, num_heads, head_size, self.model_size),
+            'qkt': QKt(),
+            'softmax': Softmax(),
+            'attn_v': AttnV(self.model_size),
+            'post_linear': PostLinear(device, self.model_size),
+            'norm_add1': NormAdd(device, self.model_size),
+            'ff1': FF1(device, self.model_size, ff_size, gelu),
+            'ff2': FF2(device, self.model_size, ff_size),
+            'norm_add2': NormAdd(device, self.model_size),
+        }
+        self.modules = {op: torch.jit.script(modules[op]) for op in ops}
+
+    def get_inputs(self, batch):
+        batch_size = len(batch)
+        max_len = int(np.amax(batch))
+        dev, heads, head, model = self.device, self.num_heads, self.head_size, self.model_size
+        q, k, v = torch.split(randn((3, heads, batch_size, max_len, head), dev), 1, 0)
+        attn = randn((1, heads, batch_size, max_len, max_len), dev)
+        return {
+            'pre_linear': [randn((batch_size * max_len, model), dev), batch_size],
+            'qkt': [q, k, get_attn_mask(batch, max_len, dev, causal=self.causal)],
+            'softmax': [attn],
+            'attn_v': [attn, v],
+            'post_linear': [randn((batch_size, max_len, model), dev), randn((batch_size, max_len, model), dev)],
+            'norm_add1': [randn((batch_size, max_len, model), dev)],
+            'ff1': [randn((batch_size, max_len, model), dev)],
+            'ff2': [randn((batch_size, max_len, self.ff_size), dev), randn((batch_size, max_len, model), dev)],
+            'norm_add2': [randn((batch_size, max_len, model), dev)],
+        }
+
+    def run(self, batches, iters):
+        """Returns the times in ms of every op on every batch.
+
+        The result maps each op to a list with, per batch, the mean time
+        and the time of every iteration, see time_iters.
+        """
+        op_results = {op: [] for op in self.ops}
+        for batch in batches:
+            inputs = self.get_inputs(batch)
+            for op in self.ops:
+                op_results[op].append(time_iters(self.modules[op], inputs[op], iters, num_threads=self.num_threads))
+        return op_results
+
+def print_op_times(op_results, args, iters):
+    # The same lines as masked_mha.py --per-op.
+    warmup = max(iters // 100, 2)
+    for op, batch_results in op_results.items():
+        times = [mean for mean, samples in batch_results]
+        print('RESULTS', op, sum(times) / len(times), sep=',')
+        run_utils.print_record([t for mean, samples in batch_results for t in samples], args, name=op,
+                               warmup=warmup, iters=iters, batch_means=times)
+    # The ops are timed separately, so the layer's time is the sum of the
+    # ops' times and an iteration of it the sum of the ops' iterations
+    # with the same index.
+    sums = [sum(mean for mean, samples in batch) for batch in zip(*op_results.values())]
+    sum_samples = [[sum(iteration) for iteration in zip(*[samples for mean, samples in batch])]
+                   for batch in zip(*op_results.values())]
+    print('RESULTS,Sum', sum(sums) / len(sums), sep=',')
+    run_utils.print_record([t for samples in sum_samples for t in samples], args, name='Sum',
+                           warmup=warmup, iters=iters, batch_means=sums)
@@ -1,47 +1,69 @@
 import os
 import time
 import tvm
+import json
 import argparse
+import ctypes
+import hashlib
 import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 import utils
 import run_utils
 
 
-def load_module(op_name, variants=None):
+# Modules stay loaded for the lifetime of the process so that a runner
+# serving many configurations (see run_utils.serve_worker) only loads each
+# library once. Workers must be restarted when the libraries are rebuilt.
+loaded_modules = {}
+def load_module_file(path):
+    if path not in loaded_modules:
+        loaded_modules[path] = tvm.runtime.module.load_module(path)
+    return loaded_modules[path]
+
+def get_module_paths(op_name, variants=None, suffix=''):
     if variants:
-        return [tvm.runtime.module.load_module(run_utils.MODULE_DIR + '/' + op_name + str(variant) + '.so') for variant in variants]
+        return [run_utils.MODULE_DIR + '/' + op_name + str(variant) + suffix + '.so' for variant in variants]
     else:
-        return [tvm.runtime.module.load_module(run_utils.MODULE_DIR + '/' + op_name + '.so')]
+        return [run_utils.MODULE_DIR + '/' + op_name + suffix + '.so']
+
+def load_module(op_name, variants=None, suffix=''):
+    return [load_module_file(path) for path in get_module_paths(op_name, variants, suffix)]
+
+# Content hashes of module files, keyed by path, mtime and size so that a
+# rebuilt library is hashed again.
+module_hashes = {}
+def hash_module_file(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in module_hashes:
+        with open(path, 'rb') as f: module_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+    return module_hashes[key]
+
+def get_modules_hash(op_name, variants=None):
+    # Identifies the kernels of an op, e.g. across rebuilds for datasets
+    # with different max lengths.
+    h = hashlib.sha256()
+    for path in get_module_paths(op_name, variants): h.update(hash_module_file(path).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def load_prep_module(op_name, variants=None):
+    # Preludes split out by --split-prep-code, if the op was built that way.
+    first = op_name + (str(variants[0]) if variants else '') + run_utils.PREP_LIB_SUFFIX + '.so'
+    if not os.path.exists(run_utils.MODULE_DIR + '/' + first): return None
+    return load_module(op_name, variants, suffix=run_utils.PREP_LIB_SUFFIX)
+
+# Parsed buffer manifests, cached like loaded_modules.
+loaded_ibuf_infos = {}
+def load_ibuf_info_file(path):
+    if path not in loaded_ibuf_infos:
+        loaded_ibuf_infos[path] = run_utils.read_buf_manifest(path)
+    return loaded_ibuf_infos[path]
 
 def load_ibuf_info(op_name, variants=None):
     if variants:
-        ret = []
-        for variant in variants:
-            bufs = [[], []]
-            with open(run_utils.MODULE_DIR + '/' + op_name + str(variant) + '_bufs.txt') as topo_file:
-                for line in topo_file:
-                    arr = line.strip().split('|')
-                    arr[1] = 'lambda bs: (' + arr[1] + ')'
-                    data = (eval(arr[1]), arr[2])
-                    if arr[0] == 'h':
-                        bufs[0].append(data)
-                    else:
-                        bufs[1].append(data)
-            ret.append(bufs)
-        return ret;
+        return [load_ibuf_info_file(run_utils.MODULE_DIR + '/' + op_name + str(variant) + '_bufs.json') for variant in variants]
     else:
-        bufs = [[], []]
-        with open(run_utils.MODULE_DIR + '/' + op_name + '_bufs.txt') as topo_file:
-            for line in topo_file:
-                arr = line.strip().split('|')
-                arr[1] = 'lambda bs: (' + arr[1] + ')'
-                data = (eval(arr[1]), arr[2])
-                if arr[0] == 'h':
-                    bufs[0].append(data)
-                else:
-                    bufs[1].append(data)
-        return [bufs]
+        return [load_ibuf_info_file(run_utils.MODULE_DIR + '/' + op_name + '_bufs.json')]
 
 def create_ibufs(ibuf_infos, batch_size, cpu_ctx, dev_ctx, alloc_op=None):
     def get_or_call(i):
@@ -70,8 +92,14 @@ class Op:
         self.module_name = module_name
         self.tensor_inputs = tensor_inputs
         self.modules = load_module(module_name, variants)
+        self.prep_modules = load_prep_module(module_name, variants)
         ibuf_info = load_ibuf_info(module_name, variants)
         self.host_ibufs, self.dev_ibufs = list(zip(*create_ibufs(ibuf_info, batch_size, cpu_ctx, dev_ctx, alloc_op=alloc_op)))
+        if self.prep_modules:
+            # A second set of auxiliary buffers, filled by the prelude of
+            # the next batch while the kernels read the current set.
+            self.spare_host_ibufs, self.spare_dev_ibufs = list(zip(*create_ibufs(ibuf_info, batch_size, cpu_ctx, dev_ctx)))
+        self.prepped_variant = None
         self.batch_size = batch_size
         self.variants = variants
         self.inputs = None
@@ -82,6 +110,29 @@ class Op:
         self.optimal_module = self.modules[variant]
         self.optimal_module_entry_func = self.modules[variant].entry_func
 
+    def bind(self):
+        # The op's current inputs and variant, to be run after they change.
+        return BoundOp(self.name, self.optimal_module_entry_func, self.inputs)
+
+    def prep(self, l_inputs, batch_size, variant):
+        """Run the prelude of a batch into the spare auxiliary buffers.
+
+        The prelude only reads the lengths, so the current tensor inputs
+        stand in for the batch's own.
+        """
+        inputs = ([batch_size] + self.tensor_inputs + l_inputs +
+                  self.spare_host_ibufs[variant] + self.spare_dev_ibufs[variant])
+        self.prep_modules[variant].entry_func(*inputs)
+        self.prepped_variant = variant
+
+    def use_prepped(self, l_inputs, variant):
+        # Make the spare buffers current, running the prelude now if they
+        # were filled for another variant or not at all.
+        if self.prepped_variant != variant: self.prep(l_inputs, self.batch_size, variant)
+        self.host_ibufs, self.spare_host_ibufs = self.spare_host_ibufs, self.host_ibufs
+        self.dev_ibufs, self.spare_dev_ibufs = self.spare_dev_ibufs, self.dev_ibufs
+        self.prepped_variant = None
+
     def reset(self):
         self.inputs = None
         self.optimal_module = None
@@ -97,20 +148,82 @@ class Op:
             means = []
             for i in range(len(self.modules)):
                 inputs = [self.batch_size] + self.tensor_inputs + l_inputs + self.host_ibufs[i] + self.dev_ibufs[i]
+                if self.prep_modules: self.prep_modules[i].entry_func(*inputs)
                 evaluator = self.modules[i].time_evaluator(self.modules[i].entry_name, ctx, number=5, repeat=20)
                 eval_result = evaluator(*inputs)
                 means.append(mean(list(eval_result.results)[1:]))
             print(self.name, means)
             return min(range(len(means)), key=means.__getitem__)
 
-    def execute_multiple(self, l_inputs, ctx):
-        means = []
+    def execute_multiple_samples(self, l_inputs, ctx):
+        # Repeat times (s) of the fastest variant, without the first repeat.
+        best = None
         for i in range(len(self.modules)):
             inputs = [self.batch_size] + self.tensor_inputs + l_inputs + self.host_ibufs[i] + self.dev_ibufs[i]
+            if self.prep_modules: self.prep_modules[i].entry_func(*inputs)
             evaluator = self.modules[i].time_evaluator(self.modules[i].entry_name, ctx, number=5, repeat=100)
             eval_result = evaluator(*inputs)
-            means.append(mean(list(eval_result.results)[1:]))
-        return min(means)
+            samples = list(eval_result.results)[1:]
+            if best is None or mean(samples) < mean(best): best = samples
+        return best
+
+    def execute_multiple(self, l_inputs, ctx):
+        return mean(self.execute_multiple_samples(l_inputs, ctx))
+
+class VariantSelector:
+    """Picks the schedule variant of each op per bucket of batch shapes.
+
+    Batches are bucketed by batch size, max length rounded up to a
+    multiple of 32 and total length rounded to a size class (see
+    run_utils.get_size_class). Variants are profiled the first time a
+    bucket is seen and the winners are kept in cache_file, if given, so
+    later runs on the same target reuse them. Winners are keyed by a hash
+    of the op's module files too, as the kernels are regenerated per
+    dataset with a different max length. Winners for other builds of a
+    module are dropped when its current build is first seen.
+    """
+    def __init__(self, target, cache_file=None):
+        self.target = target
+        self.cache_file = cache_file
+        self.winners = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as f: self.winners = json.load(f)
+
+    def get_bucket(self, lens):
+        return '%d|%d|%d' % (len(lens), utils.ceilmult(int(max(lens)), 32),
+                             run_utils.get_size_class(int(sum(lens))))
+
+    def select(self, ops, lens, l_inputs, ctx):
+        bucket = self.get_bucket(lens)
+        variants = {}
+        profiled = False
+        for op in ops:
+            module_key = '%s|%s|%s|' % (self.target, op.module_name, op.variants)
+            build_key = module_key + get_modules_hash(op.module_name, op.variants) + '|'
+            key = build_key + bucket
+            if key not in self.winners:
+                for stale in [k for k in self.winners if k.startswith(module_key) and not k.startswith(build_key)]:
+                    del self.winners[stale]
+                self.winners[key] = op.profile_variants(l_inputs, ctx)
+                profiled = profiled or bool(op.variants)
+            variants[op.name] = self.winners[key]
+        if profiled: self.save()
+        return variants
+
+    def save(self):
+        if not self.cache_file: return
+        tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f: json.dump(self.winners, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+
+class BoundOp:
+    def __init__(self, name, entry_func, inputs):
+        self.name = name
+        self.entry_func = entry_func
+        self.inputs = inputs
+
+    def execute(self):
+        self.entry_func(*self.inputs)
 
 class OpShell:
     def __init__(self, name, module_name, batch_size, tensor_inputs, cpu_ctx, dev_ctx, alloc_op=None, variants=None):
@@ -126,3 +239,103 @@ class OpShell:
 
     def execute_multiple(self, l_inputs, ctx):
          raise NotImplementedError
+
+    def execute_multiple_samples(self, l_inputs, ctx):
+         raise NotImplementedError
+
+# CUDA runtime entry points used by OpChainReplay, loaded on first use.
+cudart = None
+def get_cudart():
+    global cudart
+    if cudart is None:
+        for name in ['libcudart.so', 'libcudart.so.12', 'libcudart.so.11.0']:
+            try:
+                cudart = ctypes.CDLL(name)
+                break
+            except OSError:
+                continue
+        else:
+            raise OSError("Could not load the CUDA runtime library")
+        cudart.cudaGetErrorString.restype = ctypes.c_char_p
+    return cudart
+
+def check_cuda(status, what):
+    if status != 0:
+        raise RuntimeError('%s failed: %s' % (what, get_cudart().cudaGetErrorString(status).decode('utf-8')))
+
+def check_tvm(status, what):
+    if status != 0:
+        lib = tvm._ffi.base._LIB
+        lib.TVMGetLastError.restype = ctypes.c_char_p
+        raise RuntimeError('%s failed: %s' % (what, lib.TVMGetLastError().decode('utf-8')))
+
+class OpChainReplay:
+    """Replays a chain of ops with bound inputs as a single CUDA graph launch.
+
+    capture runs every op once on a private stream while the stream is
+    being captured, so later iterations cost one cudaGraphLaunch instead of
+    a packed function call per op. ops are Ops with their inputs set (see
+    Op.set_inputs_and_variant) or BoundOps, and the graph must be
+    recaptured whenever their inputs change. Host side work inside the
+    ops, such as the prelude computing auxiliary buffers, is not part of
+    the graph and is not repeated, unless the ops were built with
+    --split-prep-code and their prelude is run separately.
+    """
+    CAPTURE_MODE_RELAXED = 2
+
+    def __init__(self, ops, ctx):
+        self.ops = ops
+        self.ctx = ctx
+        self.stream = ctypes.c_void_p()
+        self.graph = ctypes.c_void_p()
+        self.graph_exec = ctypes.c_void_p()
+
+    def set_tvm_stream(self, stream):
+        lib = tvm._ffi.base._LIB
+        check_tvm(lib.TVMSetStream(ctypes.c_int(self.ctx.device_type), ctypes.c_int(self.ctx.device_id), stream),
+                  'TVMSetStream')
+
+    def capture(self):
+        """Capture the chain. Returns False if it cannot be captured."""
+        try:
+            rt = get_cudart()
+            lib = tvm._ffi.base._LIB
+            check_tvm(lib.TVMStreamCreate(ctypes.c_int(self.ctx.device_type), ctypes.c_int(self.ctx.device_id),
+                                          ctypes.byref(self.stream)), 'TVMStreamCreate')
+            self.set_tvm_stream(self.stream)
+            check_cuda(rt.cudaStreamBeginCapture(self.stream, ctypes.c_int(self.CAPTURE_MODE_RELAXED)),
+                       'cudaStreamBeginCapture')
+            try:
+                for op in self.ops: op.execute()
+            finally:
+                end_status = rt.cudaStreamEndCapture(self.stream, ctypes.byref(self.graph))
+            check_cuda(end_status, 'cudaStreamEndCapture')
+            check_cuda(rt.cudaGraphInstantiateWithFlags(ctypes.byref(self.graph_exec), self.graph,
+                                                        ctypes.c_ulonglong(0)), 'cudaGraphInstantiateWithFlags')
+            # Launch once, so that a graph that cannot run falls back here
+            # rather than failing in the timed loop.
+            self.launch()
+            self.sync()
+            return True
+        except Exception as e:
+            print('Could not capture the op chain, running it eagerly:', e, file=sys.stderr)
+            self.release()
+            return False
+
+    def launch(self):
+        check_cuda(get_cudart().cudaGraphLaunch(self.graph_exec, self.stream), 'cudaGraphLaunch')
+
+    def sync(self):
+        check_cuda(get_cudart().cudaStreamSynchronize(self.stream), 'cudaStreamSynchronize')
+
+    def release(self):
+        rt = cudart
+        if self.graph_exec: rt.cudaGraphExecDestroy(self.graph_exec)
+        if self.graph: rt.cudaGraphDestroy(self.graph)
+        if self.stream:
+            self.set_tvm_stream(None)
+            tvm._ffi.base._LIB.TVMStreamFree(ctypes.c_int(self.ctx.device_type), ctypes.c_int(self.ctx.device_id),
+                                             self.stream)
+        self.stream = ctypes.c_void_p()
+        self.graph = ctypes.c_void_p()
+        self.graph_exec = ctypes.c_void_p()
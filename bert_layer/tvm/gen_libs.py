@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
+import run_utils
+
+# Builds the operator libraries loaded by masked_mha.py and
+# masked_mha_cpu.py. Each operator script is compiled in its own process,
+# several at a time, and a manifest of what was built is written next to
+# the libraries. gen_libs.sh and gen_libs_cpu.sh call this script.
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+PYTHON = 'python3'
+MANIFEST_FILE = run_utils.MODULE_DIR + 'manifest.json'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset', type=str)
+parser.add_argument('bin_packed', nargs='?', default='0')
+parser.add_argument('masked', nargs='?', default='0')
+parser.add_argument('prep_overhead', nargs='?', default='0')
+parser.add_argument('--cpu', dest='cpu', default=False, action='store_true')
+parser.add_argument('--jobs', dest='jobs', default=os.cpu_count(), type=int)
+parser.add_argument('--split-prep', dest='split_prep', default=False, action='store_true')
+args = parser.parse_args()
+if args.split_prep and (args.cpu or args.prep_overhead == '1'):
+    parser.error("--split-prep is only supported for GPU libraries with the prelude included")
+
+def lib_job(op, sched=None, padding_mode=None, extra_args=[]):
+    # Mirrors the library naming in run_utils.lower_or_build.
+    variant = ''
+    job_args = list(extra_args)
+    if sched is not None:
+        variant = str(sched)
+        job_args += ['--sched', str(sched)]
+    if padding_mode is not None:
+        variant = '_' + padding_mode
+        job_args += ['--padding-mode', padding_mode]
+    return {'lib': op + variant, 'script': op + '.py', 'args': job_args}
+
+def get_gpu_jobs(args):
+    masked = args.masked == '1'
+    jobs = []
+    if not masked:
+        jobs += [lib_job('norm_add'), lib_job('pre_linear'), lib_job('post_linear')]
+        jobs += [lib_job('ff2', sched) for sched in range(1, 6)]
+        jobs += [lib_job('ff1', sched) for sched in range(1, 3)]
+
+    if masked:
+        if args.bin_packed == '1': raise ValueError("Masked bin packed operators not implemented")
+        jobs += [lib_job('masked_qkt'), lib_job('masked_attn_v'), lib_job('masked_softmax')]
+    else:
+        jobs += [lib_job('softmax')]
+        if args.bin_packed == '1':
+            jobs += [lib_job('qkt_bin_packed', extra_args=['--hfuse']),
+                     lib_job('attn_v_bin_packed', extra_args=['--hfuse'])]
+        else:
+            jobs += [lib_job('qkt', 1), lib_job('qkt', 2), lib_job('attn_v')]
+
+    common_args = ['--target', 'cuda', '--dataset', args.dataset, '--gen-lib']
+    common_args += ['--only-prep-code'] if args.prep_overhead == '1' else ['--disable-assert']
+    if args.split_prep: common_args += ['--split-prep-code']
+    if masked: common_args += ['--skip-residual']
+    for job in jobs: job['args'] = common_args + job['args']
+    return jobs
+
+def get_cpu_jobs(args):
+    jobs = [lib_job(op) for op in ['pre_linear_cpu', 'post_linear_cpu', 'qkt_cpu', 'attn_v_cpu', 'softmax_cpu']]
+    for job in jobs: job['args'] = ['--dataset', args.dataset, '--gen-lib', '--skip-residual'] + job['args']
+    return jobs
+
+def build(job):
+    cmd = [PYTHON, SCRIPT_DIR + '/' + job['script']] + job['args']
+    print(' '.join(cmd), flush=True)
+    start = time.time()
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    entry = dict(job)
+    entry['seconds'] = time.time() - start
+    entry['returncode'] = result.returncode
+    entry['files'] = [filename for filename in run_utils.get_kernel_files(job['lib'])
+                      if os.path.exists(run_utils.MODULE_DIR + filename)]
+    entry['ok'] = result.returncode == 0 and len(entry['files']) == 2
+    # Ops without a prelude build no prelude library even when it is split.
+    entry['files'] += [filename for filename in run_utils.get_kernel_files(job['lib'] + run_utils.PREP_LIB_SUFFIX)
+                       if os.path.exists(run_utils.MODULE_DIR + filename)]
+    if not entry['ok']: entry['err'] = result.stderr.decode('utf-8')[-4096:]
+    return entry
+
+jobs = get_cpu_jobs(args) if args.cpu else get_gpu_jobs(args)
+libs = [job['lib'] for job in jobs]
+assert len(set(libs)) == len(libs), "Two jobs would write the same library"
+
+os.makedirs(run_utils.MODULE_DIR, exist_ok=True)
+for filename in os.listdir(run_utils.MODULE_DIR):
+    os.remove(run_utils.MODULE_DIR + filename)
+
+start = time.time()
+with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+    built = list(executor.map(build, jobs))
+
+manifest = {
+    'dataset': args.dataset,
+    'target': 'llvm' if args.cpu else 'cuda',
+    'git_rev': run_utils.get_git_revision(),
+    'seconds': time.time() - start,
+    'libs': built,
+}
+with open(MANIFEST_FILE, 'w') as manifest_file: json.dump(manifest, manifest_file, indent=1)
+
+failed = [entry for entry in built if not entry['ok']]
+for entry in failed:
+    print('Failed to build %s:\n%s' % (entry['lib'], entry['err']), file = sys.stderr)
+print('Built %d/%d libraries in %gs' % (len(built) - len(failed), len(built), manifest['seconds']))
+sys.exit(1 if failed else 0)
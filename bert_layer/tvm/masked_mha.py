@@ -9,7 +9,8 @@ import ast
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 import utils
 import run_utils
-from common import Op
+import ragged_sizes
+from common import Op, OpChainReplay, VariantSelector
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--target', nargs='?', default='llvm')
@@ -18,6 +19,7 @@ parser.add_argument('--max-batches', dest='max_batches', default=200, type=int)
 parser.add_argument('--witers', dest='witers', default=100, type=int)
 parser.add_argument('--iters', dest='iters', default=200, type=int)
 parser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
+parser.add_argument('--max-tokens', dest='max_tokens', default=None, type=int)
 parser.add_argument('--dense-storage', dest='dense_storage', default=False, action='store_true')
 parser.add_argument('--average', dest='average', default=False, action='store_true')
 parser.add_argument('--bin-packed', dest='bin_packed', default=False, action='store_true')
@@ -25,222 +27,315 @@ parser.add_argument('--masked-mha', dest='masked_mha', default=False, action='st
 parser.add_argument('--plain-mha', dest='plain_mha', default=False, action='store_true')
 parser.add_argument('--per-op', dest='per_op', default=False, action='store_true')
 parser.add_argument('--dataset', nargs='?', default='random_384_512')
+parser.add_argument('--no-pool', dest='no_pool', default=False, action='store_true')
+parser.add_argument('--device-init', dest='device_init', default=False, action='store_true')
+parser.add_argument('--replay', dest='replay', default=False, action='store_true')
+parser.add_argument('--num-layers', dest='num_layers', default=1, type=int)
+parser.add_argument('--online-variants', dest='online_variants', default=False, action='store_true')
+parser.add_argument('--variant-cache', dest='variant_cache', nargs='?', default=None)
+parser.add_argument('--worker', dest='worker', default=False, action='store_true')
 args = parser.parse_args()
 
-BATCH_SIZE = args.batch_size
-MAX_LEN = max(64, utils.ceilmult(run_utils.get_dataset_max_len(args.dataset), 32))
-NUM_HEADS = 8
-HEAD_SIZE = 64
-MODEL_DIM = NUM_HEADS * HEAD_SIZE
-FF_DIM = 2048
-
-dev_ctx = run_utils.get_ctx(args.target)
-cpu_ctx = run_utils.get_ctx("llvm")
-
-only_mha = args.plain_mha or args.masked_mha
-
-qkt_module = 'qkt'
-attn_v_module = 'attn_v'
-softmax_module = 'softmax'
-assert not (args.bin_packed and only_mha)
-assert not (args.masked_mha and args.plain_mha)
-if args.bin_packed:
-    qkt_module = 'qkt_bin_packed'
-    attn_v_module = 'attn_v_bin_packed'
-elif args.masked_mha:
-    qkt_module = 'masked_qkt'
-    attn_v_module = 'masked_attn_v'
-    softmax_module = 'masked_softmax'
-
-if args.plain_mha or args.masked_mha:
-    if args.masked_mha: qkt_variants = None
-    else: qkt_variants = [1]
-else: qkt_variants = [1, 2]
-
-if not only_mha:
-    ops = {
-        'pre_linear': Op('pre_linear', 'pre_linear', BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'qkt': Op('qkt', qkt_module, BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=qkt_variants),
-        'softmax': Op('softmax', softmax_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'attn_v': Op('attn_v', attn_v_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'post_linear': Op('post_linear', 'post_linear', BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'norm_add1': Op('norm_add1', 'norm_add', BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'ff1': Op('ff1', 'ff1', BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=[1, 2]),
-        'ff2': Op('ff2', 'ff2', BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=[1, 2, 3, 4, 5]),
-        'norm_add2': Op('norm_add2', 'norm_add', BATCH_SIZE, [], cpu_ctx, dev_ctx),
-    }
-
-    ops_order = [
-        ops['pre_linear'],
-        ops['qkt'],
-        ops['softmax'],
-        ops['attn_v'],
-        ops['post_linear'],
-        ops['norm_add1'],
-        ops['ff1'],
-        ops['ff2'],
-        ops['norm_add2'],
-    ]
-else:
-    ops = {
-        'qkt': Op('qkt', qkt_module, BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=qkt_variants),
-        'softmax': Op('softmax', softmax_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
-        'attn_v': Op('attn_v', attn_v_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
-    }
-
-    ops_order = [
-        ops['qkt'],
-        ops['softmax'],
-        ops['attn_v'],
-    ]
-
-
-# l_inputs: Allocate tensors
-batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset)
-batches = run_utils.reverse_sort_batches(batches)
-if args.average:
-    for i in range(len(batches)):
-        avg = np.mean(batches[i])
-        batches[i].fill(avg)
-        batches[i] = batches[i].astype('int32')
-batches = run_utils.append_padded_sum(batches, 64)
-
-pre_linear_in_w = run_utils.create_tvm_array((3, NUM_HEADS, HEAD_SIZE, MODEL_DIM), "float32", dev_ctx, lw_args={})
-pre_linear_in_b = run_utils.create_tvm_array((3, NUM_HEADS, HEAD_SIZE,), "float32", dev_ctx, lw_args={})
-post_linear_in_w = run_utils.create_tvm_array((NUM_HEADS * HEAD_SIZE, MODEL_DIM), "float32", dev_ctx, lw_args={})
-post_linear_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-if not only_mha:
-    norm_add1_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-    norm_add1_in_g = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-    norm_add2_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-    norm_add2_in_g = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-    ff1_in_w = run_utils.create_tvm_array((MODEL_DIM, FF_DIM), "float32", dev_ctx, lw_args={})
-    ff1_in_b = run_utils.create_tvm_array((FF_DIM,), "float32", dev_ctx, lw_args={})
-    ff2_in_w = run_utils.create_tvm_array((FF_DIM, MODEL_DIM), "float32", dev_ctx, lw_args={})
-    ff2_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
-
-times = []
-time_dict = {}
-if args.per_op:
-    for op in ops_order:
-        time_dict[op.name] = []
-batch_size_ = BATCH_SIZE + 1
-
-optimal_variants = None
-for batch in batches:
-    sum1 = run_utils.prefix_sum(batch_size_, lambda i: batch[i])
-    sum16 = run_utils.prefix_sum(batch_size_, lambda i: utils.ceilmult(batch[i], 16))
-    sum32 = run_utils.prefix_sum(batch_size_, lambda i: utils.ceilmult(batch[i], 32))
-    sum64 = run_utils.prefix_sum(batch_size_, lambda i: utils.ceilmult(batch[i], 64))
-    sum264 = run_utils.prefix_sum(batch_size_, lambda i: utils.ceilmult(batch[i], 64) * utils.ceilmult(batch[i], 64))
-
-    # t_inputs: Allocate tensors
-    pre_linear_in_qkv = run_utils.create_ragged_array((batch_size_ * MAX_LEN, MODEL_DIM), sum1*MODEL_DIM, "float32", dev_ctx)
-    pre_linear_out = run_utils.create_ragged_array((3, batch_size_, MAX_LEN, NUM_HEADS, HEAD_SIZE),
-                                                   3*sum64*NUM_HEADS*HEAD_SIZE, "float32", dev_ctx)
-
-    qkt_in_q = pre_linear_out
-    qkt_in_k = pre_linear_out
-    qkt_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, NUM_HEADS, MAX_LEN), NUM_HEADS*sum264, "float32", dev_ctx)
-
-    softmax_in = qkt_out
-    softmax_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, NUM_HEADS, MAX_LEN), NUM_HEADS*sum264, "float32", dev_ctx)
-
-    attn_v_in_attn = softmax_out
-    attn_v_in_v = pre_linear_out
-    attn_v_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, NUM_HEADS, HEAD_SIZE),
-                                               NUM_HEADS*HEAD_SIZE*sum64, "float32", dev_ctx)
+def main(args):
+    run_utils.use_device_init(args.device_init)
+    BATCH_SIZE = args.batch_size
+    MAX_LEN = max(64, utils.ceilmult(run_utils.get_dataset_max_len(args.dataset), 32))
+    NUM_HEADS = 8
+    HEAD_SIZE = 64
+    MODEL_DIM = NUM_HEADS * HEAD_SIZE
+    FF_DIM = 2048
+
+    dev_ctx = run_utils.get_ctx(args.target)
+    cpu_ctx = run_utils.get_ctx("llvm")
+
+    only_mha = args.plain_mha or args.masked_mha
+    assert args.num_layers == 1 or not (only_mha or args.per_op)
+
+    qkt_module = 'qkt'
+    attn_v_module = 'attn_v'
+    softmax_module = 'softmax'
+    assert not (args.bin_packed and only_mha)
+    assert not (args.masked_mha and args.plain_mha)
+    if args.bin_packed:
+        qkt_module = 'qkt_bin_packed'
+        attn_v_module = 'attn_v_bin_packed'
+    elif args.masked_mha:
+        qkt_module = 'masked_qkt'
+        attn_v_module = 'masked_attn_v'
+        softmax_module = 'masked_softmax'
+
+    if args.plain_mha or args.masked_mha:
+        if args.masked_mha: qkt_variants = None
+        else: qkt_variants = [1]
+    else: qkt_variants = [1, 2]
 
     if not only_mha:
-        post_linear_in_a = attn_v_out
-        post_linear_in_a2 = pre_linear_in_qkv.create_view((batch_size_, MAX_LEN, MODEL_DIM))
-        post_linear_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
-
-        norm_add1_in_a = post_linear_out
-        norm_add1_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
-
-        ff1_in_a = norm_add1_out
-        ff1_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, FF_DIM), FF_DIM*sum1, "float32", dev_ctx)
-
-        ff2_in_a = ff1_out
-        ff2_in_a2 = norm_add1_out
-        ff2_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
-
-        norm_add2_in_a = ff2_out
-        norm_add2_out = run_utils.create_ragged_array((batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
-
-
-    if not only_mha:
-        ops['pre_linear'].tensor_inputs = [pre_linear_in_qkv, pre_linear_in_w, pre_linear_in_b, pre_linear_out]
-    ops['qkt'].tensor_inputs = [qkt_in_q, qkt_in_k, qkt_out]
-    ops['softmax'].tensor_inputs = [softmax_in, softmax_out]
-    ops['attn_v'].tensor_inputs = [attn_v_in_v, attn_v_in_attn, attn_v_out]
+        ops = {
+            'pre_linear': Op('pre_linear', 'pre_linear', BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'qkt': Op('qkt', qkt_module, BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=qkt_variants),
+            'softmax': Op('softmax', softmax_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'attn_v': Op('attn_v', attn_v_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'post_linear': Op('post_linear', 'post_linear', BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'norm_add1': Op('norm_add1', 'norm_add', BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'ff1': Op('ff1', 'ff1', BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=[1, 2]),
+            'ff2': Op('ff2', 'ff2', BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=[1, 2, 3, 4, 5]),
+            'norm_add2': Op('norm_add2', 'norm_add', BATCH_SIZE, [], cpu_ctx, dev_ctx),
+        }
+
+        ops_order = [
+            ops['pre_linear'],
+            ops['qkt'],
+            ops['softmax'],
+            ops['attn_v'],
+            ops['post_linear'],
+            ops['norm_add1'],
+            ops['ff1'],
+            ops['ff2'],
+            ops['norm_add2'],
+        ]
+    else:
+        ops = {
+            'qkt': Op('qkt', qkt_module, BATCH_SIZE, [], cpu_ctx, dev_ctx, variants=qkt_variants),
+            'softmax': Op('softmax', softmax_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
+            'attn_v': Op('attn_v', attn_v_module, BATCH_SIZE, [], cpu_ctx, dev_ctx),
+        }
+
+        ops_order = [
+            ops['qkt'],
+            ops['softmax'],
+            ops['attn_v'],
+        ]
+
+
+    # l_inputs: Allocate tensors
+    # With --max-tokens, batches hold at most BATCH_SIZE sequences within a
+    # budget of padded tokens. Ops and buffers are sized for BATCH_SIZE
+    # sequences and only the batch size passed to the ops varies.
+    if args.max_tokens:
+        batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset,
+                                            policy='tokens', max_tokens=args.max_tokens)
+    else:
+        batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, args.dataset)
+    batches = run_utils.reverse_sort_batches(batches)
+    if args.average:
+        for i in range(len(batches)):
+            avg = np.mean(batches[i])
+            batches[i].fill(avg)
+            batches[i] = batches[i].astype('int32')
+    batches = run_utils.append_padded_sum(batches, 64)
+
+    pre_linear_in_w = run_utils.create_tvm_array((3, NUM_HEADS, HEAD_SIZE, MODEL_DIM), "float32", dev_ctx, lw_args={})
+    pre_linear_in_b = run_utils.create_tvm_array((3, NUM_HEADS, HEAD_SIZE,), "float32", dev_ctx, lw_args={})
+    post_linear_in_w = run_utils.create_tvm_array((NUM_HEADS * HEAD_SIZE, MODEL_DIM), "float32", dev_ctx, lw_args={})
+    post_linear_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
     if not only_mha:
-        ops['post_linear'].tensor_inputs = [post_linear_in_a, post_linear_in_a2, post_linear_in_w, post_linear_in_b, post_linear_out]
-        ops['norm_add1'].tensor_inputs = [norm_add1_in_a, norm_add1_in_b, norm_add1_in_g, norm_add1_out]
-        ops['ff1'].tensor_inputs = [ff1_in_a, ff1_in_w, ff1_in_b, ff1_out]
-        ops['ff2'].tensor_inputs = [ff2_in_a, ff2_in_a2, ff2_in_w, ff2_in_b, ff2_out]
-        ops['norm_add2'].tensor_inputs = [norm_add2_in_a, norm_add2_in_b, norm_add2_in_g, norm_add2_out]
+        norm_add1_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
+        norm_add1_in_g = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
+        norm_add2_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
+        norm_add2_in_g = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
+        ff1_in_w = run_utils.create_tvm_array((MODEL_DIM, FF_DIM), "float32", dev_ctx, lw_args={})
+        ff1_in_b = run_utils.create_tvm_array((FF_DIM,), "float32", dev_ctx, lw_args={})
+        ff2_in_w = run_utils.create_tvm_array((FF_DIM, MODEL_DIM), "float32", dev_ctx, lw_args={})
+        ff2_in_b = run_utils.create_tvm_array((MODEL_DIM,), "float32", dev_ctx, lw_args={})
+
+    # times holds the mean time of every batch and samples the time of
+    # every timed iteration, over all batches.
+    times = []
+    samples = []
+    time_dict = {}
+    samples_dict = {}
+    if args.per_op:
+        for op in ops_order:
+            time_dict[op.name] = []
+            samples_dict[op.name] = []
+    batch_size_ = BATCH_SIZE + 1
+    array_pool = run_utils.RaggedArrayPool(enabled=not args.no_pool)
+
+    prelude_in_timing = True
+    optimal_variants = None
+    variant_selector = VariantSelector(args.target, args.variant_cache) if args.online_variants else None
+    batch_sums = ragged_sizes.get_sums(batches, ['sum1', 'sum64', 'sum264'])
+    # Pooled buffers are sized for the largest batch, so that they are
+    # allocated once, whatever the order of the batches.
+    max_sums = ragged_sizes.get_max(batch_sums)
+    for b, batch in enumerate(batches):
+        if args.max_tokens:
+            for op in ops_order: op.batch_size = len(batch) - 1
+        sums = max_sums if array_pool.enabled else ragged_sizes.at(batch_sums, b)
+        sum1, sum64, sum264 = sums['sum1'], sums['sum64'], sums['sum264']
+
+        # t_inputs: Allocate tensors
+        pre_linear_in_qkv = array_pool.get('pre_linear_in_qkv', (batch_size_ * MAX_LEN, MODEL_DIM), sum1*MODEL_DIM, "float32", dev_ctx)
+        pre_linear_out = array_pool.get('pre_linear_out', (3, batch_size_, MAX_LEN, NUM_HEADS, HEAD_SIZE),
+                                        3*sum64*NUM_HEADS*HEAD_SIZE, "float32", dev_ctx)
+
+        qkt_in_q = pre_linear_out
+        qkt_in_k = pre_linear_out
+        qkt_out = array_pool.get('qkt_out', (batch_size_, MAX_LEN, NUM_HEADS, MAX_LEN), NUM_HEADS*sum264, "float32", dev_ctx)
+
+        softmax_in = qkt_out
+        softmax_out = array_pool.get('softmax_out', (batch_size_, MAX_LEN, NUM_HEADS, MAX_LEN), NUM_HEADS*sum264, "float32", dev_ctx)
+
+        attn_v_in_attn = softmax_out
+        attn_v_in_v = pre_linear_out
+        attn_v_out = array_pool.get('attn_v_out', (batch_size_, MAX_LEN, NUM_HEADS, HEAD_SIZE),
+                                    NUM_HEADS*HEAD_SIZE*sum64, "float32", dev_ctx)
+
+        if not only_mha:
+            post_linear_in_a = attn_v_out
+            post_linear_in_a2 = pre_linear_in_qkv.create_view((batch_size_, MAX_LEN, MODEL_DIM))
+            post_linear_out = array_pool.get('post_linear_out', (batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
+
+            norm_add1_in_a = post_linear_out
+            norm_add1_out = array_pool.get('norm_add1_out', (batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
+
+            ff1_in_a = norm_add1_out
+            ff1_out = array_pool.get('ff1_out', (batch_size_, MAX_LEN, FF_DIM), FF_DIM*sum1, "float32", dev_ctx)
+
+            ff2_in_a = ff1_out
+            ff2_in_a2 = norm_add1_out
+            ff2_out = array_pool.get('ff2_out', (batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
+
+            norm_add2_in_a = ff2_out
+            norm_add2_out = array_pool.get('norm_add2_out', (batch_size_, MAX_LEN, MODEL_DIM), MODEL_DIM*sum1, "float32", dev_ctx)
+
+            if args.num_layers > 1:
+                layer_out = array_pool.get('layer_out', (batch_size_ * MAX_LEN, MODEL_DIM), sum1*MODEL_DIM, "float32", dev_ctx)
+
+
+        if not only_mha:
+            ops['pre_linear'].tensor_inputs = [pre_linear_in_qkv, pre_linear_in_w, pre_linear_in_b, pre_linear_out]
+        ops['qkt'].tensor_inputs = [qkt_in_q, qkt_in_k, qkt_out]
+        ops['softmax'].tensor_inputs = [softmax_in, softmax_out]
+        ops['attn_v'].tensor_inputs = [attn_v_in_v, attn_v_in_attn, attn_v_out]
+        if not only_mha:
+            ops['post_linear'].tensor_inputs = [post_linear_in_a, post_linear_in_a2, post_linear_in_w, post_linear_in_b, post_linear_out]
+            ops['norm_add1'].tensor_inputs = [norm_add1_in_a, norm_add1_in_b, norm_add1_in_g, norm_add1_out]
+            ops['ff1'].tensor_inputs = [ff1_in_a, ff1_in_w, ff1_in_b, ff1_out]
+            ops['ff2'].tensor_inputs = [ff2_in_a, ff2_in_a2, ff2_in_w, ff2_in_b, ff2_out]
+            ops['norm_add2'].tensor_inputs = [norm_add2_in_a, norm_add2_in_b, norm_add2_in_g, norm_add2_out]
+
+        l_inputs = [tvm.nd.array(batch, cpu_ctx)]
+
+        if variant_selector:
+            # The last entry is the padding added by append_padded_sum.
+            optimal_variants = variant_selector.select(ops_order, batch[:-1], l_inputs, dev_ctx)
+        elif not optimal_variants:
+            optimal_variants = {}
+            for op in ops_order:
+                optimal_variants[op.name] = op.profile_variants(l_inputs, dev_ctx)
+            print(optimal_variants)
+
+        if args.per_op:
+            this_time = 0
+            op_samples = []
+            for op in ops_order:
+                op_samples.append(op.execute_multiple_samples(l_inputs, dev_ctx))
+                op_time = run_utils.mean(op_samples[-1])
+                if (args.per_op):
+                    time_dict[op.name].append(op_time)
+                    samples_dict[op.name] += op_samples[-1]
+                this_time += op_time
+            times.append(this_time)
+            # The ops are timed separately, so a repeat of the layer is the
+            # sum of the ops' repeats with the same index.
+            samples += [sum(repeat) for repeat in zip(*op_samples)]
+        else:
+            # Ops built with --split-prep-code run their prelude on the host
+            # into a second set of auxiliary buffers. The prelude of this
+            # batch ran while the previous batch was timed and the one of
+            # the next batch runs, once per iteration, while this one is.
+            prep_ops = [op for op in ops_order if op.prep_modules]
+            for op in prep_ops: op.use_prepped(l_inputs, optimal_variants[op.name])
+            next_batch = batches[b + 1] if b + 1 < len(batches) else batch
+            next_l_inputs = [tvm.nd.array(next_batch, cpu_ctx)]
+            next_batch_size = len(next_batch) - 1 if args.max_tokens else BATCH_SIZE
+
+            for op in ops_order: op.set_inputs_and_variant(l_inputs, optimal_variants[op.name])
+            chain = ops_order
+            if args.num_layers > 1:
+                # Layers share weights and ping-pong between two activation
+                # buffers, even layers reading pre_linear_in_qkv and writing
+                # layer_out and odd layers the other way around.
+                layer_bufs = [pre_linear_in_qkv, layer_out]
+                chain = []
+                for layer in range(args.num_layers):
+                    layer_in, layer_res = layer_bufs[layer % 2], layer_bufs[(layer + 1) % 2]
+                    ops['pre_linear'].tensor_inputs[0] = layer_in
+                    ops['post_linear'].tensor_inputs[1] = layer_in.create_view((batch_size_, MAX_LEN, MODEL_DIM))
+                    ops['norm_add2'].tensor_inputs[-1] = layer_res.create_view((batch_size_, MAX_LEN, MODEL_DIM))
+                    for op in ops_order:
+                        op.set_inputs_and_variant(l_inputs, optimal_variants[op.name])
+                        chain.append(op.bind())
+
+            replay = OpChainReplay(chain, dev_ctx) if args.replay else None
+            if replay and not replay.capture(): replay = None
+            # A replayed graph does not repeat the preludes inside the ops.
+            # Only the preludes of ops built with --split-prep-code, which
+            # run below, are then part of the timing.
+            if replay and len(prep_ops) < len(ops_order): prelude_in_timing = False
+
+            def run_iter():
+                if replay: replay.launch()
+                else:
+                    for op in chain: op.execute()
+                for op in prep_ops: op.prep(next_l_inputs, next_batch_size, optimal_variants[op.name])
+            sync = replay.sync if replay else dev_ctx.sync
+
+            for i in range(args.witers): run_iter()
+            sync()
+            start = time.perf_counter()
+            for i in range(args.iters): run_iter()
+            sync()
+            end = time.perf_counter()
+            times.append((end - start) / args.iters)
+            # A second pass times every iteration on its own, up to the
+            # device being done with it, for the latency jitter. Its host
+            # round trips stay out of the pipelined time above.
+            for i in range(args.iters):
+                start = time.perf_counter()
+                run_iter()
+                sync()
+                samples.append(time.perf_counter() - start)
+            if replay: replay.release()
+
+            for op in ops_order: op.reset()
+
+
+        # memset_out_qkv.__del__()
+        # pre_linear_in_qkv.__del__()
+        # qkt_out.__del__()
+        # softmax_out.__del__()
+        # attn_v_out.__del__()
+        # post_linear_out.__del__()
+        # norm_add1_out.__del__()
+        # ff1_out.__del__()
+        # ff2_out.__del__()
+        # norm_add2_out.__del__()
+        gc.collect()
 
-    l_inputs = [tvm.nd.array(batch, cpu_ctx)]
 
-    if not optimal_variants:
-        optimal_variants = {}
+    if args.per_op:
         for op in ops_order:
-            optimal_variants[op.name] = op.profile_variants(l_inputs, dev_ctx)
-        print(optimal_variants)
+            op_times = time_dict[op.name]
+            op_time = (sum(op_times)*1000.0) / len(op_times)
+            print('RESULTS', op.name, op_time, sep=',')
+            run_utils.print_record([t * 1000.0 for t in samples_dict[op.name]], args, name=op.name,
+                                   warmup=5, iters=5 * 99, batch_means=[t * 1000.0 for t in op_times])
 
+    total_time = sum(times)*1000.0
     if args.per_op:
-        this_time = 0
-        for op in ops_order:
-            op_time = op.execute_multiple(l_inputs, dev_ctx)
-            if (args.per_op):
-                time_dict[op.name].append(op_time)
-            this_time += op_time
-        times.append(this_time)
+        print('RESULTS,Sum', total_time / (len(batches)), sep=',')
+        run_utils.print_record([t * 1000.0 for t in samples], args, name='Sum', warmup=5, iters=5 * 99,
+                               batch_means=[t * 1000.0 for t in times])
     else:
-        for op in ops_order: op.set_inputs_and_variant(l_inputs, optimal_variants[op.name])
-        for i in range(args.witers):
-            for op in ops_order: op.execute()
-        dev_ctx.sync()
-        start = time.perf_counter()
-        for i in range(args.iters):
-            for op in ops_order: op.execute()
-        dev_ctx.sync()
-        end = time.perf_counter()
-        times.append((end - start) / args.iters)
-
-        for op in ops_order: op.reset()
-
-
-
-
-    # memset_out_qkv.__del__()
-    # pre_linear_in_qkv.__del__()
-    # qkt_out.__del__()
-    # softmax_out.__del__()
-    # attn_v_out.__del__()
-    # post_linear_out.__del__()
-    # norm_add1_out.__del__()
-    # ff1_out.__del__()
-    # ff2_out.__del__()
-    # norm_add2_out.__del__()
-    gc.collect()
-
-
-
-
-
-
-
-if args.per_op:
-    for op in ops_order:
-        op_times = time_dict[op.name]
-        time = (sum(op_times)*1000.0) / len(op_times)
-        print('RESULTS', op.name, time, sep=',')
-
-total_time = sum(times)*1000.0
-if args.per_op:
-    print('RESULTS,Sum', total_time / (len(batches)), sep=',')
-else:
-    print('RESULTS', total_time / (len(batches)), sep=',')
+        print('RESULTS', total_time / (len(batches)), sep=',')
+        # The last length of each batch is the padding from append_padded_sum.
+        throughput = run_utils.print_throughput([batch[:-1] for batch in batches], [t * 1000.0 for t in times])
+        run_utils.print_record([t * 1000.0 for t in samples], args, warmup=args.witers, iters=args.iters,
+                               num_layers=args.num_layers, tokens_per_s=throughput,
+                               prelude_in_timing=prelude_in_timing,
+                               batch_means=[t * 1000.0 for t in times])
+
+if args.worker: run_utils.serve_worker(parser, main)
+else: main(args)
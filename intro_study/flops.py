@@ -7,6 +7,7 @@ import argparse
 import ast
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
 import run_utils
+import ragged_sizes
 import utils
 
 parser = argparse.ArgumentParser()
@@ -28,24 +29,21 @@ def flops_for_dataset_batch(dataset, batch_size, max_batches):
     total_dense_gflops = 0.0
     total_real_gflops = 0.0
     total_ragged_gflops = 0.0
-    for batch in batches:
+    padded_batches = run_utils.append_padded_sum(batches, 64)
+    batch_sums = ragged_sizes.get_sums(batches, ['sum1', 'sum2'])
+    padded_sums = ragged_sizes.get_sums(padded_batches, ['sum1', 'sum2', 'sum264', 'sum21664', 'sum2132'])
+    for b, batch in enumerate(batches):
         if len(batch) != batch_size:
             continue
 
         batch_max_len = np.amax(batch)
-        padded_batch = run_utils.append_padded_sum([batch], 64)[0]
-
-        sum1 = run_utils.prefix_sum(batch_size, lambda i: batch[i])
-        sum2 = run_utils.prefix_sum(batch_size, lambda i: batch[i] * batch[i])
-
-        psum1 = run_utils.prefix_sum(batch_size + 1, lambda i: padded_batch[i])
-        psum2 = run_utils.prefix_sum(batch_size + 1, lambda i: padded_batch[i] * padded_batch[i])
-        psum264 = run_utils.prefix_sum(batch_size + 1,
-                                       lambda i: utils.ceilmult(padded_batch[i], 64) * utils.ceilmult(padded_batch[i], 64))
-        psum21664 = run_utils.prefix_sum(batch_size + 1,
-                                         lambda i: utils.ceilmult(padded_batch[i], 16) * utils.ceilmult(padded_batch[i], 64))
-        psum2132 = run_utils.prefix_sum(batch_size + 1,
-                                        lambda i: padded_batch[i] * utils.ceilmult(padded_batch[i], 32))
+
+        sums = ragged_sizes.at(batch_sums, b)
+        sum1, sum2 = sums['sum1'], sums['sum2']
+
+        psums = ragged_sizes.at(padded_sums, b)
+        psum1, psum2 = psums['sum1'], psums['sum2']
+        psum264, psum21664, psum2132 = psums['sum264'], psums['sum21664'], psums['sum2132']
 
         # print(sum2, psum264, psum2132, psum21664, batch)
         def get_pre_linear_flops():
@@ -0,0 +1,54 @@
+import numpy as np
+
+# Sizes of ragged buffers for many batches of sequence lengths at once.
+#
+# A ragged buffer stores each sequence padded up to a multiple of one or
+# more factors, so its size is a sum over the batch of products of padded
+# lengths. A term names such a product by its factors, e.g. sum264 is
+# sum(ceilmult(l, 64) * ceilmult(l, 64)) and sum2132 is
+# sum(l * ceilmult(l, 32)). The names follow the ones the runners used
+# with run_utils.prefix_sum.
+TERMS = {
+    'sum1': (1,),
+    'sum2': (1, 1),
+    'sum16': (16,),
+    'sum32': (32,),
+    'sum64': (64,),
+    'sum264': (64, 64),
+    'sum21664': (16, 64),
+    'sum2132': (1, 32),
+}
+
+def ceilmult(lens, factor):
+    lens = np.asarray(lens, 'int64')
+    return lens if factor == 1 else factor * ((lens + factor - 1) // factor)
+
+def get_sums(batches, terms=None):
+    """Sums of the terms (names in TERMS, all by default) for every batch.
+
+    Returns a dict from term name to an int64 array with one sum per batch.
+    """
+    terms = list(TERMS.keys()) if terms is None else terms
+    lens = np.concatenate([np.asarray(batch, 'int64') for batch in batches]) if batches else np.zeros(0, 'int64')
+    ends = np.cumsum([len(batch) for batch in batches], dtype='int64')
+    starts = ends - np.array([len(batch) for batch in batches], 'int64')
+
+    padded = {}
+    ret = {}
+    for term in terms:
+        values = np.ones(len(lens), 'int64')
+        for factor in TERMS[term]:
+            if factor not in padded: padded[factor] = ceilmult(lens, factor)
+            values = values * padded[factor]
+        # Differences of an inclusive scan, so empty batches sum to 0.
+        scan = np.concatenate([[0], np.cumsum(values)])
+        ret[term] = scan[ends] - scan[starts]
+    return ret
+
+def at(sums, b):
+    """The sums of batch b as a dict of python ints."""
+    return {term: int(values[b]) for term, values in sums.items()}
+
+def get_max(sums):
+    """The largest sum of every term over all batches, as python ints."""
+    return {term: int(np.amax(values)) if len(values) else 0 for term, values in sums.items()}
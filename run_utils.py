@@ -1,7 +1,19 @@
 import gc
+import io
 import sys
+import json
+import time
+import queue
+import shutil
+import hashlib
+import operator
 import utils
 import argparse
+import contextlib
+import threading
+import traceback
+import platform
+import subprocess
 import os
 import numpy as np
 np.random.seed(0)
@@ -36,6 +48,7 @@ dataset_max_lens = {
 DATASETS = list(dataset_max_lens.keys())
 
 MODULE_DIR = os.path.dirname(os.path.realpath(__file__)) + '/bert_layer/tvm/genlibs/'
+KERNEL_CACHE_DIR = os.path.dirname(os.path.realpath(__file__)) + '/bert_layer/tvm/kernel_cache/'
 DATA_DIR = os.path.dirname(os.path.realpath(__file__)) + '/data/'
 
 def get_arm_target():
@@ -59,9 +72,19 @@ def get_cmd_parser(no_options=False):
         parser.add_argument('--layout-unfused', dest='layout_unfused', default=False, action='store_true')
         parser.add_argument('--dataset', nargs='?', default='random')
         parser.add_argument('--only-prep-code', dest='only_prep_code', default=False, action='store_true')
+        parser.add_argument('--split-prep-code', dest='split_prep_code', default=False, action='store_true')
+        parser.add_argument('--prefetch', dest='prefetch', default=0, type=int)
+        parser.add_argument('--end-to-end', dest='end_to_end', default=False, action='store_true')
         parser.add_argument('--no-raggedness', dest='no_raggedness', default=False, action='store_true')
+        parser.add_argument('--no-kernel-cache', dest='no_kernel_cache', default=False, action='store_true')
     return parser
 
+def get_num_threads(threads, default=8):
+    # An explicit thread count, else the one a pinned sweep exports (see
+    # scripts/common.py get_pinned_env), else default.
+    if threads: return threads
+    return int(os.environ.get('OMP_NUM_THREADS', default))
+
 def prefix_sum(extent, fn):
     s = 0
     for i in range(extent):
@@ -108,9 +131,81 @@ def get_shape(t, rmap):
         print(t)
         assert False
 
+# With device_init, benchmark tensors are filled in place by a generated
+# kernel instead of being drawn with NumPy and copied over, see
+# use_device_init.
+device_init = False
+init_counter = 0
+fill_kernels = {}
+
+def use_device_init(enabled):
+    global device_init, init_counter
+    device_init = enabled
+    init_counter = 0
+
+def hash_u32(x):
+    # The lowbias32 integer hash.
+    import tvm
+    def c(v): return tvm.tir.const(v, 'uint32')
+    x = x ^ (x >> c(16))
+    x = x * c(0x7feb352d)
+    x = x ^ (x >> c(15))
+    x = x * c(0x846ca68b)
+    return x ^ (x >> c(16))
+
+def get_fill_kernel(ctx, dtype):
+    """Kernel filling a flat buffer of n elements with N(0, 1) samples.
+
+    Values are a counter-based function of the element index and a seed,
+    turned into normal samples with the Box-Muller transform.
+    """
+    import tvm
+    from tvm import te
+    key = (ctx.device_type, dtype)
+    if key not in fill_kernels:
+        n = te.var('n')
+        seed = te.var('seed', dtype='uint32')
+
+        def uniform(counter):
+            # In (0, 1], so that the log below stays finite.
+            bits = hash_u32(counter) >> tvm.tir.const(8, 'uint32')
+            return (bits + tvm.tir.const(1, 'uint32')).astype('float32') * (1.0 / (1 << 24))
+
+        def normal(i):
+            counter = i.astype('uint32') * tvm.tir.const(2, 'uint32') + seed
+            u1, u2 = uniform(counter), uniform(counter + tvm.tir.const(1, 'uint32'))
+            return (tvm.sqrt(-2.0 * tvm.log(u1)) * tvm.cos(2.0 * np.pi * u2)).astype(dtype)
+
+        O = te.compute((n,), normal, name='O')
+        s = tvm.create_schedule([O.op])
+        x_o, x_i = s[O].split(O.op.axis[0], factor=256)
+        if ctx.device_type == tvm.cpu(0).device_type:
+            s[O].parallel(x_o)
+            target = 'llvm'
+        else:
+            s[O].bind(x_o, te.thread_axis("blockIdx.x"))
+            s[O].bind(x_i, te.thread_axis("threadIdx.x"))
+            target = 'cuda'
+        # n is passed explicitly, so the buffer may be a ragged array
+        # whose dense shape does not match.
+        with tvm.build_config(disable_assert=True):
+            fill_kernels[key], _ = tvm.build(s, [n, seed, O], target)
+    return fill_kernels[key]
+
+def fill_random(tvm_array, flat_size, dtype, ctx):
+    global init_counter
+    kernel = get_fill_kernel(ctx, dtype)
+    # Offset the counters of every array so arrays do not repeat each other.
+    kernel(int(flat_size), (init_counter * 2) & 0xffffffff, tvm_array)
+    init_counter += int(flat_size)
+    return tvm_array
+
 def create_ragged_array(dense_shape, flat_size, dtype, ctx):
     # print("YO1: ", flat_size)
     import tvm
+    if device_init:
+        tvm_array = tvm.nd.ragged_empty(dense_shape, flat_size, dtype=dtype, ctx=ctx)
+        return fill_random(tvm_array, flat_size, dtype, ctx)
     # src_np_array = np.random.default_rng().random((flat_size,), dtype=np.float32)
     src_np_array = np.random.normal(size=(flat_size,)).astype(dtype)
     # src_np_array = np.full((flat_size,), 0.1, dtype).astype(dtype)
@@ -119,6 +214,41 @@ def create_ragged_array(dense_shape, flat_size, dtype, ctx):
     del src_np_array
     return tvm_array
 
+def get_size_class(size):
+    # Rounds size up to one of four classes per power of two, so a pooled
+    # array never wastes more than a quarter of its capacity.
+    size = int(size)
+    if size <= 4: return max(size, 1)
+    step = 1 << (size.bit_length() - 3)
+    return -(-size // step) * step
+
+class RaggedArrayPool:
+    """Ragged arrays reused across batches, one per named buffer.
+
+    A buffer is reallocated only when a batch needs more than its current
+    capacity. Runners request every buffer at its size for the largest
+    batch of the run (see ragged_sizes.get_max), so allocation and the
+    random host to device fill happen once per run, on the first batch.
+    Contents are left over from earlier batches, which does not matter for
+    timing. With enabled=False every get allocates a fresh array.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.arrays = {}
+
+    def get(self, name, dense_shape, flat_size, dtype, ctx):
+        if not self.enabled: return create_ragged_array(dense_shape, flat_size, dtype, ctx)
+        key = (name, tuple(dense_shape), dtype, str(ctx))
+        array, capacity = self.arrays.get(key, (None, 0))
+        if flat_size > capacity:
+            # Drop the old array first to keep peak memory down.
+            self.arrays.pop(key, None)
+            del array
+            capacity = get_size_class(flat_size)
+            array = create_ragged_array(dense_shape, capacity, dtype, ctx)
+            self.arrays[key] = (array, capacity)
+        return array
+
 def create_numpy_array(t, dtype, rmap={}, lw_args=None):
     shape = get_shape(t, rmap)
     # print("YO2: ", shape)
@@ -136,6 +266,10 @@ def create_tvm_array(t, dtype, ctx, rmap={}, lw_args=None):
         # print(t, flat_size, shape)
         return create_ragged_array(shape, flat_size, dtype, ctx)
 
+    if device_init:
+        tvm_array = tvm.nd.empty(shape, dtype=dtype, ctx=ctx)
+        return fill_random(tvm_array, int(np.prod(shape)), dtype, ctx)
+
     # return np.zeros(shape, dtype)
     # return tvm.nd.array(np.full(shape, 0.1, dtype), ctx)
     # print("YO3: ", shape)
@@ -161,38 +295,135 @@ def get_ctx(target):
 def mean(l):
     return sum(l) / len(l)
 
-def execute(target, built, inputs, ctx, debug = False):
+# execute_samples times EXECUTE_REPEAT repeats of EXECUTE_NUMBER runs
+# each and drops the first EXECUTE_WARMUP_REPEATS of them.
+EXECUTE_NUMBER = 10
+EXECUTE_REPEAT = 50
+EXECUTE_WARMUP_REPEATS = 10
+EXECUTE_WARMUP = EXECUTE_NUMBER * EXECUTE_WARMUP_REPEATS
+EXECUTE_ITERS = EXECUTE_NUMBER * (EXECUTE_REPEAT - EXECUTE_WARMUP_REPEATS)
+
+def execute_samples(target, built, inputs, ctx, debug = False):
+    """Times in ms of the timed repeats of built on inputs, see EXECUTE_REPEAT."""
     if debug:
         if target == 'c':
             built['default_function'](*inputs)
         else:
             built(*inputs)
         ctx.sync()
-        return -100000000
+        return [-100000000]
     else:
         if target == 'c':
             built['default_function'](*inputs)
-            return -100000000
+            return [-100000000]
             evaluator = built.time_evaluator('default_function', ctx, 1, repeat=10)
         else:
             # evaluator = built.time_evaluator(built.entry_name, ctx, repeat=5, number=20)
-            evaluator = built.time_evaluator(built.entry_name, ctx, repeat=5, number=100)
+            evaluator = built.time_evaluator(built.entry_name, ctx, repeat=EXECUTE_REPEAT, number=EXECUTE_NUMBER)
         eval_result = evaluator(*inputs)
-        return mean(list(eval_result.results)[1:]) * 1000
-        # return mean(list(eval_result.results)) * 1000
+        return [t * 1000 for t in list(eval_result.results)[EXECUTE_WARMUP_REPEATS:]]
+
+def execute(target, built, inputs, ctx, debug = False):
+    return mean(execute_samples(target, built, inputs, ctx, debug))
+
+RECORD_MARKER = 'RECORD'
+git_revision = None
+
+def get_git_revision():
+    global git_revision
+    if git_revision is None:
+        try:
+            result = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    cwd=os.path.dirname(os.path.realpath(__file__)))
+            git_revision = result.stdout.decode('utf-8').strip() or 'unknown'
+        except OSError:
+            git_revision = 'unknown'
+    return git_revision
+
+def make_record(samples, args, name=None, warmup=0, iters=1, **extra):
+    """Summarize timing samples (in ms) of one configuration as a result record.
+
+    samples are the raw timings, one per timed iteration (or repeat, for
+    runners timed with a TVM time_evaluator) over all batches, so that the
+    percentiles reflect latency jitter. Runners that time a loop of
+    back to back iterations take them in a second pass that syncs the
+    device after each iteration, so they include a host round trip. The
+    batch_means extra holds the mean of each batch from the back to back
+    loop, the time the runner reports as RESULTS.
+    """
+    samples = [float(sample) for sample in samples]
+    arr = np.array(samples) if samples else np.array([np.nan])
+    record = {
+        'name': name,
+        'samples': samples,
+        'mean': float(np.mean(arr)),
+        'var': float(np.var(arr)),
+        'min': float(np.amin(arr)),
+        'max': float(np.amax(arr)),
+        'p50': float(np.percentile(arr, 50)),
+        'p90': float(np.percentile(arr, 90)),
+        'p99': float(np.percentile(arr, 99)),
+        'warmup': warmup,
+        'iters': iters,
+        'device': getattr(args, 'target', None),
+        'host': platform.node(),
+        'git_rev': get_git_revision(),
+        'config': {k: v for k, v in vars(args).items() if k != 'worker'},
+    }
+    record.update(extra)
+    return record
+
+THROUGHPUT_MARKER = 'THROUGHPUT'
+
+def get_throughput(batches, batch_times):
+    # Real tokens per second, given the time of each batch in ms.
+    tokens = sum(int(np.sum(batch)) for batch in batches)
+    return tokens / (sum(batch_times) / 1000.0)
+
+def print_throughput(batches, batch_times):
+    throughput = get_throughput(batches, batch_times)
+    print(THROUGHPUT_MARKER, throughput, sep=',')
+    return throughput
+
+def print_record(samples, args, name=None, warmup=0, iters=1, **extra):
+    record = make_record(samples, args, name=name, warmup=warmup, iters=iters, **extra)
+    print(RECORD_MARKER, json.dumps(record), sep=',')
 
 def chunks(lst, n, m):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, min(m * n, len(lst)), n):
         yield np.array(lst[i:i + n], "int32")
 
-def read_lengths(filename, skip = 0):
-    data_lines = [int(line.strip()) for line in open(filename, "r", errors='replace')]
-    return data_lines[skip:]
+def get_lengths_store_file(filename):
+    return os.path.splitext(filename)[0] + '.npy'
+
+def build_lengths_store(filename):
+    """Convert a text lengths file into a binary .npy store next to it."""
+    lengths = np.loadtxt(filename, dtype='int64', ndmin=1)
+    dtype = 'int16' if len(lengths) == 0 or np.amax(lengths) <= np.iinfo('int16').max else 'int32'
+    store_file = get_lengths_store_file(filename)
+    # Several runners may race to build the same store, so write to a
+    # private file and atomically move it into place.
+    tmp_file = '%s.%d.tmp' % (store_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.save(f, lengths.astype(dtype))
+    os.replace(tmp_file, store_file)
+    return store_file
+
+def open_lengths_store(filename):
+    store_file = get_lengths_store_file(filename)
+    if (not os.path.exists(store_file) or
+        os.path.getmtime(store_file) < os.path.getmtime(filename)):
+        build_lengths_store(filename)
+    return np.load(store_file, mmap_mode='r')
+
+def read_lengths(filename, skip = 0, count = None):
+    lengths = open_lengths_store(filename)
+    end = len(lengths) if count is None else skip + count
+    return lengths[skip:end]
 
 def read_and_chunk_lengths(batch_size, max_batches, lengths_file):
-    curr_dir = os.path.dirname(os.path.realpath(__file__))
-    data_lines = read_lengths(lengths_file)
+    data_lines = read_lengths(lengths_file, count = batch_size * max_batches)
     return list(chunks(data_lines, batch_size, max_batches))
 
 def read_and_chunk_gemm_dims(batch_size, max_batches, filename):
@@ -218,12 +449,22 @@ def is_ragged(t):
         print(t)
         assert False
 
-def get_nlp_batches(batch_size, num_batches, dataset):
+def get_nlp_batches(batch_size, num_batches, dataset, policy='fifo', max_tokens=None):
+    """Batches of the first batch_size * num_batches lengths of dataset.
+
+    Policies other than fifo regroup those lengths, see batching.py, and
+    may return a different number of batches.
+    """
     if dataset.startswith("random"):
         _, avg_seq_len, max_seq_len = dataset.split("_")
-        return [random_lengths(batch_size, int(avg_seq_len), int(max_seq_len)) for i in range(num_batches)]
+        batches = [random_lengths(batch_size, int(avg_seq_len), int(max_seq_len)) for i in range(num_batches)]
     else:
-        return read_and_chunk_lengths(batch_size, num_batches, DATA_DIR + "/" + dataset_files[dataset])
+        batches = read_and_chunk_lengths(batch_size, num_batches, DATA_DIR + "/" + dataset_files[dataset])
+    if policy == 'fifo': return batches
+    import batching
+    lengths = np.concatenate(batches) if batches else []
+    return batching.form_batches(lengths, policy, batch_size, max_tokens=max_tokens,
+                                 max_len=get_dataset_max_len(dataset))
 
 def run(built, i_inputs_tensors, t_inputs_tensors, batch_size, num_batches, dataset, datadir, target, debug):
     import tvm
@@ -299,6 +540,41 @@ def run2(built, i_inputs_tensors, t_inputs_tensors, lw_args, args, pad_sum=None)
     return t_inputs, batches
 
 
+def prefetch(items, prepare, depth):
+    """Yields prepare(item) for each item in order.
+
+    With depth > 0, a background thread prepares up to depth items ahead
+    of the consumer, so that preparing the next batch's inputs overlaps
+    with the device running the current one. Errors in prepare are raised
+    in the consumer.
+    """
+    if depth <= 0:
+        for item in items: yield prepare(item)
+        return
+
+    prepared = queue.Queue(maxsize=depth)
+    done = object()
+    def produce():
+        try:
+            for item in items: prepared.put((prepare(item), None))
+            prepared.put((done, None))
+        except Exception as e:
+            prepared.put((None, e))
+
+    # A daemon, so that a consumer stopping early does not hang the exit.
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    while True:
+        ret, error = prepared.get()
+        if error is not None: raise error
+        if ret is done: break
+        yield ret
+    producer.join()
+
+def call_built(target, built, inputs):
+    if target == 'c': built['default_function'](*inputs)
+    else: built(*inputs)
+
 def get_bert_layer_run_fn(bs_var):
     import tvm
     print('BS_VAR', bs_var)
@@ -320,8 +596,7 @@ def get_bert_layer_run_fn(bs_var):
             batches = [sorted(batch, reverse=True) for batch in batches]
             if pad_sum: batches = append_padded_sum(batches, pad_sum)
 
-            time = 0
-            for batch in batches:
+            def prepare(batch):
                 t_inputs = ([batch_size] +
                             [create_tvm_array(i, "float32", ctx, rmap=rmap, lw_args=lw_args([batch]))
                              for i in t_inputs_tensors[1:]])
@@ -329,10 +604,34 @@ def get_bert_layer_run_fn(bs_var):
                     l_inputs = [tvm.nd.array(batch, ctx)]
                 else:
                     l_inputs = [tvm.nd.array(batch, cpu_ctx)]
-                inputs = t_inputs + l_inputs + host_i_inputs + dev_i_inputs
-                time += execute(args.target, built, inputs, ctx, args.debug)
+                return batch, t_inputs, t_inputs + l_inputs + host_i_inputs + dev_i_inputs
+
+            depth = getattr(args, 'prefetch', 0)
+            if getattr(args, 'end_to_end', False) and not args.debug:
+                # Every batch runs once and the whole stream, input
+                # preparation included, is timed. The first batch warms up.
+                batch, t_inputs, inputs = prepare(batches[0])
+                call_built(args.target, built, inputs)
+                ctx.sync()
+                start = time.perf_counter()
+                for batch, t_inputs, inputs in prefetch(batches, prepare, depth):
+                    call_built(args.target, built, inputs)
+                ctx.sync()
+                samples = [(time.perf_counter() - start) * 1000.0 / len(batches)]
+                print("RESULTS", batch_size, samples[0], sep=',')
+                print_record(samples, args, name='end_to_end', batch_size=batch_size, num_batches=len(batches),
+                             prefetch=depth)
+                continue
+
+            samples, batch_means = [], []
+            for batch, t_inputs, inputs in prefetch(batches, prepare, depth):
+                batch_samples = execute_samples(args.target, built, inputs, ctx, args.debug)
+                samples += batch_samples
+                batch_means.append(mean(batch_samples))
             gc.collect()
-            print("RESULTS", batch_size, time / len(batches), sep=',')
+            print("RESULTS", batch_size, sum(batch_means) / len(batches), sep=',')
+            print_record(samples, args, warmup=EXECUTE_WARMUP, iters=EXECUTE_ITERS, batch_size=batch_size,
+                         batch_means=batch_means)
             # print(host_i_inputs[0].asnumpy())
             # print(dev_i_inputs[0].asnumpy())
             if args.debug:
@@ -434,40 +733,207 @@ def run_trmm(built, i_inputs_tensors, t_inputs_tensors, lw_args, args, pad_sum=N
         t_inputs[i] = t_inputs[i].asnumpy(target=target, is_src_ragged=is_ragged(t_inputs_tensors[i]))
     return t_inputs
 
+# Auxiliary buffer manifests. lower_or_build describes the shape of every
+# host and device auxiliary buffer of a generated library as expression
+# trees over the batch size variable: an int, the name 'bs', or
+# [op, lhs, rhs] with op from BUF_EXPR_OPS.
+BUF_EXPR_OPS = {
+    'Add': 'add',
+    'Sub': 'sub',
+    'Mul': 'mul',
+    'Div': 'floordiv',
+    'FloorDiv': 'floordiv',
+    'Mod': 'floormod',
+    'FloorMod': 'floormod',
+    'Min': 'min',
+    'Max': 'max',
+}
+
+BUF_EXPR_FUNCS = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'floordiv': operator.floordiv,
+    'floormod': operator.mod,
+    'min': min,
+    'max': max,
+}
+
+def buf_expr_to_json(expr):
+    import tvm
+    if isinstance(expr, int): return expr
+    if isinstance(expr, tvm.tir.IntImm): return expr.value
+    if isinstance(expr, tvm.tir.Cast): return buf_expr_to_json(expr.value)
+    if isinstance(expr, tvm.tir.Var):
+        # All batch size dependent shapes are in terms of the 'bs' var.
+        assert expr.name == 'bs', "Unexpected variable in buffer shape: " + str(expr)
+        return 'bs'
+    op = BUF_EXPR_OPS.get(type(expr).__name__)
+    if op is None: raise ValueError("Unsupported expression in buffer shape: " + str(expr))
+    return [op, buf_expr_to_json(expr.a), buf_expr_to_json(expr.b)]
+
+def write_buf_manifest(filename, i_bufs):
+    def buf_entries(bufs):
+        return [{'shape': [buf_expr_to_json(e) for e in buf.shape.dense_shape()], 'dtype': buf.dtype} for buf in bufs]
+    manifest = {'host': buf_entries(i_bufs[0]), 'device': buf_entries(i_bufs[1])}
+    with open(filename, 'w') as buf_file: json.dump(manifest, buf_file)
+
+def compile_buf_expr(expr):
+    if isinstance(expr, int): return lambda bs: expr
+    if expr == 'bs': return lambda bs: bs
+    if not isinstance(expr, list) or len(expr) != 3 or expr[0] not in BUF_EXPR_FUNCS:
+        raise ValueError("Malformed buffer shape expression: " + repr(expr))
+    fn = BUF_EXPR_FUNCS[expr[0]]
+    lhs, rhs = compile_buf_expr(expr[1]), compile_buf_expr(expr[2])
+    return lambda bs: fn(lhs(bs), rhs(bs))
+
+def compile_buf_shape(shape):
+    dims = [compile_buf_expr(e) for e in shape]
+    return lambda bs: [dim(bs) for dim in dims]
+
+def read_buf_manifest(filename):
+    """Returns [host bufs, device bufs] of (shape fn of the batch size, dtype) pairs."""
+    with open(filename) as buf_file: manifest = json.load(buf_file)
+    return [[(compile_buf_shape(buf['shape']), buf['dtype']) for buf in manifest[kind]]
+            for kind in ['host', 'device']]
+
+def hash_files(filenames):
+    ret = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, 'rb') as f: ret.update(f.read())
+    return ret.hexdigest()
+
+def get_tvm_build_id():
+    # Kernels built by a different compiler build must not be reused.
+    import tvm
+    lib = getattr(getattr(tvm._ffi.base, '_LIB', None), '_name', '')
+    mtime = os.stat(lib).st_mtime_ns if lib and os.path.exists(lib) else ''
+    return '%s|%s|%s' % (tvm.__version__, lib, mtime)
+
+def get_kernel_cache_key(lib_name, args, build_config):
+    """Key of a kernel library generated by the running operator script.
+
+    Datasets only enter the key through their padded max length, so that
+    datasets in the same cluster share kernels. Some schedules also test
+    the dataset name (e.g. args.dataset in ['cola', 'mrpc']), so the name
+    is kept when the operator source mentions it.
+    """
+    script = os.path.realpath(sys.argv[0])
+    with open(script) as f: source = f.read()
+    config = {k: v for k, v in vars(args).items() if k not in ['dataset', 'gen_lib', 'no_kernel_cache']}
+    dataset = args.dataset if ("'%s'" % args.dataset) in source else None
+    key = [lib_name, hash_files([script, __file__, utils.__file__]), get_tvm_build_id(),
+           get_maxlen_padded(args.dataset), dataset, sorted(config.items()), sorted(build_config.items())]
+    return hashlib.sha256(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+
+PREP_LIB_SUFFIX = '_prep'
+
+def get_kernel_files(lib_name):
+    return [lib_name + '.so', lib_name + '_bufs.json']
+
+def restore_cached_kernel(key, lib_name):
+    cache_dir = KERNEL_CACHE_DIR + key + '/'
+    if not os.path.isdir(cache_dir): return False
+    os.makedirs(MODULE_DIR, exist_ok=True)
+    for filename in get_kernel_files(lib_name):
+        shutil.copyfile(cache_dir + filename, MODULE_DIR + filename)
+    print('Reusing cached kernel', lib_name, key)
+    return True
+
+def store_cached_kernel(key, lib_name):
+    cache_dir = KERNEL_CACHE_DIR + key + '/'
+    tmp_dir = '%s%s.%d.tmp/' % (KERNEL_CACHE_DIR, key, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for filename in get_kernel_files(lib_name):
+        shutil.copyfile(MODULE_DIR + filename, tmp_dir + filename)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another build stored the same kernel first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def get_build_config(args, prep_code_mode, hoist_loads):
+    return dict(prep_code_mode=prep_code_mode,
+                fill_in_function_bodies=not args.debug_functions,
+                hoist_loads=hoist_loads,
+                disable_assert=args.disable_assert if hasattr(args, 'disable_assert') else False)
+
+def gen_lib(lib_name, s, inputs, args, build_config, binds=None):
+    import tvm
+    with tvm.build_config(**build_config):
+        cache_key = None
+        if not getattr(args, 'no_kernel_cache', False):
+            cache_key = get_kernel_cache_key(lib_name, args, build_config)
+            if restore_cached_kernel(cache_key, lib_name): return
+
+        fadd, i_bufs = tvm.build(s, inputs, args.target, binds=binds)
+        fadd.export_library(MODULE_DIR + lib_name + '.so')
+        write_buf_manifest(MODULE_DIR + lib_name + '_bufs.json', i_bufs)
+        if cache_key: store_cached_kernel(cache_key, lib_name)
+
 def lower_or_build(name, s, inputs, args, prep_code_mode='with_prep_code', binds=None,
                    size_fn={}, pad_sum=None, substitutes=None, run_function=run2, hoist_loads=False):
     import tvm
     prep_code_mode = 'only_prep_code' if args.only_prep_code else prep_code_mode
-    with tvm.build_config(prep_code_mode=prep_code_mode,
-                          fill_in_function_bodies=not args.debug_functions,
-                          hoist_loads=hoist_loads,
-                          disable_assert=args.disable_assert if hasattr(args, 'disable_assert') else False):
-        if args.gen_lib:
-            fadd, i_bufs = tvm.build(s, inputs, args.target, binds=binds)
-            variant = ''
-            if hasattr(args, 'sched'): variant = str(args.sched)
-            if hasattr(args, 'padding_mode'): variant = '_' + str(args.padding_mode)
-            fadd.export_library(MODULE_DIR + name + variant + '.so')
-            with open(MODULE_DIR + name + variant + '_bufs.txt', 'w') as buf_file:
-                for buf in i_bufs[0]:
-                    print('h', buf.shape.dense_shape(), buf.dtype, file=buf_file, sep='|')
-                for buf in i_bufs[1]:
-                    print('d', buf.shape.dense_shape(), buf.dtype, file=buf_file, sep='|')
-            return None, None
+    build_config = get_build_config(args, prep_code_mode, hoist_loads)
+    if args.gen_lib:
+        variant = ''
+        if hasattr(args, 'sched'): variant = str(args.sched)
+        if hasattr(args, 'padding_mode'): variant = '_' + str(args.padding_mode)
+        lib_name = name + variant
+        if getattr(args, 'split_prep_code', False) and prep_code_mode == 'with_prep_code':
+            # The prelude computing the auxiliary buffers from the lengths
+            # goes into its own library, so that runners can run it on the
+            # host ahead of the kernels (see common.Op.prep).
+            gen_lib(lib_name, s, inputs, args, get_build_config(args, 'no_prep_code', hoist_loads), binds=binds)
+            gen_lib(lib_name + PREP_LIB_SUFFIX, s, inputs, args,
+                    get_build_config(args, 'only_prep_code', hoist_loads), binds=binds)
         else:
-            if args.debug_code == 'ir':
-                lowered = tvm.lower(s, inputs, args.target, simple_mode=True, binds=binds, substitutes=substitutes)
-                print(lowered)
-                return None, None
-            elif args.debug_code == 'code':
-                fadd, _ = tvm.build(s, inputs, args.target, binds=binds)
-                if args.target == 'cuda':
-                    print('-----GPU code-----\n' + fadd.imported_modules[0].get_source())
-                else:
-                    print('-----CPU code-----\n' + fadd.get_source())
-                return None, None
+            gen_lib(lib_name, s, inputs, args, build_config, binds=binds)
+        return None, None
+    with tvm.build_config(**build_config):
+        if args.debug_code == 'ir':
+            lowered = tvm.lower(s, inputs, args.target, simple_mode=True, binds=binds, substitutes=substitutes)
+            print(lowered)
+            return None, None
+        elif args.debug_code == 'code':
+            fadd, _ = tvm.build(s, inputs, args.target, binds=binds)
+            if args.target == 'cuda':
+                print('-----GPU code-----\n' + fadd.imported_modules[0].get_source())
             else:
-                assert args.debug_code is None
-                fadd, i_bufs = tvm.build(s, inputs, args.target, binds=binds, substitutes=substitutes)
-                # fadd = tvm.runtime.module.load_module('/home/ppf/rnn_compilers/ragged_tensors/incubator-tvm/build/attn_v.so')
-                return run_function(fadd, i_bufs, inputs[1], size_fn, args, pad_sum=pad_sum)
+                print('-----CPU code-----\n' + fadd.get_source())
+            return None, None
+        else:
+            assert args.debug_code is None
+            fadd, i_bufs = tvm.build(s, inputs, args.target, binds=binds, substitutes=substitutes)
+            # fadd = tvm.runtime.module.load_module('/home/ppf/rnn_compilers/ragged_tensors/incubator-tvm/build/attn_v.so')
+            return run_function(fadd, i_bufs, inputs[1], size_fn, args, pad_sum=pad_sum)
+
+def serve_worker(parser, run_fn):
+    """Run configurations sent by scripts/common.py in this process.
+
+    Each line on stdin is a JSON list of command line arguments. The
+    configuration is parsed with parser, passed to run_fn and answered with
+    one JSON line holding the exit status and the captured stdout/stderr.
+    """
+    # Keep the real stdout for replies and send anything native code
+    # prints there to stderr instead, so it cannot corrupt the protocol.
+    reply_file = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    for line in sys.stdin:
+        if not line.strip(): continue
+        out, err = io.StringIO(), io.StringIO()
+        status = 0
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                np.random.seed(0)
+                run_fn(parser.parse_args(json.loads(line)))
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            gc.collect()
+        print(json.dumps({'status': status, 'out': out.getvalue(), 'err': err.getvalue()}),
+              file=reply_file, flush=True)
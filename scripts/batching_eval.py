@@ -0,0 +1,47 @@
+import os
+import sys
+import common as com
+import run_utils
+import ragged_sizes
+from common import get_out_files
+import batching
+import argparse
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--out-dir', dest='out_dir', nargs='?', default='perf_results')
+parser.add_argument('--dataset', nargs='?', default=None)
+parser.add_argument('--max-batches', dest='max_batches', default=10, type=int)
+parser.add_argument('--batch-size', dest='batch_size', default=128, type=int)
+parser.add_argument('--max-tokens', dest='max_tokens', default=None, type=int)
+parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
+parser.add_argument('--append', dest='append', default=False, action='store_true')
+args = parser.parse_args()
+args.target = ''
+
+datasets = com.get_all_datasets() if args.dataset is None else [args.dataset]
+
+out_prefix = 'batching'
+results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+header = 'Dataset,Policy,Batches,Mean Batch Size,Padding Efficiency'
+print(header, file = results_out)
+
+for dataset in datasets:
+    # By default the token budget is a full batch of sequences at the
+    # dataset's mean length padded to a multiple of 32, so that it binds
+    # on batches with longer than average sequences. A budget of the max
+    # length never binds and makes tokens the same as fifo.
+    max_tokens = args.max_tokens
+    if not max_tokens:
+        lengths = np.concatenate(run_utils.get_nlp_batches(args.batch_size, args.max_batches, dataset))
+        max_tokens = int(args.batch_size * ragged_sizes.ceilmult(lengths, 32).mean())
+    for policy in batching.POLICIES:
+        batches = run_utils.get_nlp_batches(args.batch_size, args.max_batches, dataset,
+                                            policy=policy, max_tokens=max_tokens)
+        mean_size = sum(len(batch) for batch in batches) / len(batches)
+        out_str = '%s,%s,%d,%g,%g' % (dataset, policy, len(batches), mean_size, batching.padding_efficiency(batches))
+        print(out_str, file = results_out)
+
+if not args.stdout:
+    results_out.close()
+    results_err.close()
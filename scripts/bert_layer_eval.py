@@ -7,6 +7,7 @@ import argparse
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 PYTORCH_RUNNER_CPU = SCRIPT_DIR + '/../bert_layer/pytorch/layer_cpu.py'
 PYTORCH_RUNNER_GPU = SCRIPT_DIR + '/../bert_layer/pytorch/layer.py'
+PYTORCH_MICRO_BATCH_RUNNER = SCRIPT_DIR + '/../bert_layer/pytorch/layer_micro_batch.py'
 TVM_GPU_EXE_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/masked_mha.py'
 TVM_CPU_EXE_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/masked_mha_cpu.py'
 TVM_MEM_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/training_memory.py'
@@ -23,9 +24,12 @@ def generate_tvm_libs(dataset, target, args):
            '1' if args.bin_packed else '0',
            '0',
            '1' if args.prep_overhead else '0']
+    if args.host_prep: cmd += ['--split-prep']
     print(' '.join(cmd))
     out, err = run_cmd(cmd)
     print(out, err)
+    # Workers keep the previous libraries loaded.
+    com.close_workers()
 
 def run_pytorch(b_size, dataset, n_batch, err_file, args):
     print(args.target, args.target == "cpu")
@@ -39,12 +43,26 @@ def run_pytorch(b_size, dataset, n_batch, err_file, args):
     if args.target == "cpu": cmd += ['--masked-mha']
 
     print(' '.join(cmd))
-    out, err = run_cmd(cmd)
-    if err: print(err, file = err_file)
+    out, err = com.run_cached(cmd, pooled=args.workers)
+    if err: com.print_err(err, err_file)
 
+    if not args.mem: com.save_records(results_records, out, err, framework='pytorch', dataset=dataset, batch_size=b_size)
     if args.mem: return com.extract_mem(out)
     else: return com.extract_times(out, 1)[0]
 
+def run_pytorch_micro_batch(b_size, dataset, n_batch, err_file, args):
+    log(args, ' Batch size %d' % (b_size))
+    cmd = [PYTHON, PYTORCH_MICRO_BATCH_RUNNER, '--target', target, '--batch-size', str(b_size),
+           '--max-batches', str(n_batch), '--dataset', dataset,
+           '--micro-batch-size', str(args.micro_batch_size), '--concurrency', args.micro_batch_concurrency]
+
+    print(' '.join(cmd))
+    out, err = com.run_cached(cmd, pooled=args.workers)
+    if err: com.print_err(err, err_file)
+
+    com.save_records(results_records, out, err, framework='pytorch_micro_batch', dataset=dataset, batch_size=b_size)
+    return com.extract_times(out, 1)[0]
+
 def get_ftrans_runner(no_pad):
     def run_ftrans(b_size, dataset, n_batch, err_file, args):
         log(args, ' Batch size %d' % (b_size))
@@ -57,9 +75,9 @@ def get_ftrans_runner(no_pad):
                    str(com.get_dataset_max_len(dataset)), str(num_layers), '1' if no_pad else '0']
 
         # print(' '.join(cmd))
-        out, err = run_cmd(cmd)
+        out, err = com.run_cached(cmd)
         # print(out)
-        if err: print(err, file = err_file)
+        if err: com.print_err(err, err_file)
 
         if args.mem: return com.extract_mem(out)
         else: return com.extract_times(out, 1)[0]
@@ -79,10 +97,11 @@ def get_cora_runner(balance):
         if balance: cmd += ['--average']
         if args.target == "cpu": cmd += ['--masked-mha']
         print(' '.join(cmd))
-        out, err = run_cmd(cmd)
+        out, err = com.run_cached(cmd, deps=com.get_tvm_libs(), pooled=args.workers and runner != TVM_MEM_RUNNER)
         print(out)
-        if err: print(err, file = err_file)
+        if err: com.print_err(err, err_file)
 
+        if not args.mem: com.save_records(results_records, out, err, framework='cora', dataset=dataset, batch_size=b_size)
         if args.mem: return com.extract_mem(out)
         else: return com.extract_times(out, 1)[0]
     return run_cora
@@ -92,8 +111,8 @@ def get_cora_memory_runner(dense):
         log(args, ' Batch size %d' % (b_size))
         cmd = [PYTHON, TVM_MEM_RUNNER, '--batch-size', str(b_size), '--max-batches', str(n_batch), '--dataset', dataset]
         if dense: cmd += ['--dense-storage']
-        out, err = run_cmd(cmd)
-        if err: print(err, file = err_file)
+        out, err = com.run_cached(cmd)
+        if err: com.print_err(err, err_file)
         return com.extract_mem(out)
     return run_cora
 
@@ -104,11 +123,20 @@ parser.add_argument('--dataset', nargs='?', default=None)
 parser.add_argument('--max-batches', dest='max_batches', default=1, type=int)
 parser.add_argument('--bin-packed', dest='bin_packed', default=False, action='store_true')
 parser.add_argument('--prep-overhead', dest='prep_overhead', default=False, action='store_true')
+parser.add_argument('--host-prep', dest='host_prep', default=False, action='store_true')
 parser.add_argument('--gen-libs', dest='gen_libs', default=False, action='store_true')
 parser.add_argument('--mem', dest='mem', default=False, action='store_true')
 parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
 parser.add_argument('--append', dest='append', default=False, action='store_true')
+parser.add_argument('--workers', dest='workers', default=False, action='store_true')
+parser.add_argument('--cache', dest='cache', default=False, action='store_true')
+parser.add_argument('--parallel', dest='parallel', default=False, action='store_true')
+parser.add_argument('--threads-per-job', dest='threads_per_job', default=8, type=int)
+parser.add_argument('--micro-batch-size', dest='micro_batch_size', default=8, type=int)
+parser.add_argument('--micro-batch-concurrency', dest='micro_batch_concurrency', nargs='?', default='streams',
+                    choices=['serial', 'streams'])
 args = parser.parse_args()
+if args.cache: com.enable_cache(args)
 
 # batch_sizes = [1, 2, 4, 8, 16, 32, 64, 128]
 # batch_sizes = [2]
@@ -137,6 +165,7 @@ else:
     else:
         framework_funs = {
             'pytorch': lambda b_sizes, *args: com.batchify(b_sizes, run_pytorch, *args),
+            'pytorch_micro_batch': lambda b_sizes, *args: com.batchify(b_sizes, run_pytorch_micro_batch, *args),
             'ftrans_pad': lambda b_sizes, *args: com.batchify(b_sizes, get_ftrans_runner(False), *args),
             'ftrans_nopad': lambda b_sizes, *args: com.batchify(b_sizes, get_ftrans_runner(True), *args),
             'cora': lambda b_sizes, *args: com.batchify(b_sizes, get_cora_runner(False), *args),
@@ -144,21 +173,33 @@ else:
 
 out_prefix = 'bert_layer'
 if args.prep_overhead: out_prefix += '_prelude'
+if args.host_prep: out_prefix += '_hostprep'
 if args.mem: out_prefix += '_mem'
 
 results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+results_records = com.get_records_file(args, out_prefix, 'a' if args.append else 'w')
 header = 'Target,Dataset,Batch Size'
 for framework, func in framework_funs.items(): header += ',' + framework + ' (ms)'
 print(header, file = results_out)
 
+# Concurrent points would contend for a single GPU, so only CPU sweeps run in parallel.
+parallel = args.parallel and args.target == "cpu"
+core_sets = com.get_core_sets(args.threads_per_job) if parallel else None
 for target in targets:
     for _, dataset_list in datasets.items():
         if args.gen_libs: generate_tvm_libs(dataset_list[0], target, args);
+        if parallel:
+            log(args, 'Running %s %s on %d core sets' % (target, dataset_list, len(core_sets)))
+            parallel_times = com.run_sweep_parallel(framework_funs, dataset_list, batch_sizes, core_sets,
+                                                    args.max_batches, results_err, args)
         for dataset in dataset_list:
             exe_times = {}
             for framework, func in framework_funs.items():
-                log(args, 'Running %s %s %s %s' % (target, dataset, framework, batch_sizes))
-                exe_times[framework] = func(batch_sizes, dataset, args.max_batches, results_err, args)
+                if parallel:
+                    exe_times[framework] = parallel_times[(dataset, framework)]
+                else:
+                    log(args, 'Running %s %s %s %s' % (target, dataset, framework, batch_sizes))
+                    exe_times[framework] = func(batch_sizes, dataset, args.max_batches, results_err, args)
                 print(exe_times[framework])
 
             for b_size in batch_sizes:
@@ -170,3 +211,4 @@ for target in targets:
 if not args.stdout:
     results_out.close()
     results_err.close()
+    results_records.close()
@@ -27,23 +27,28 @@ def generate_tvm_libs(dataset, target, args):
     out, err = run_cmd(cmd)
     print(out, err)
 
-def run_pytorch(b_size, dataset, n_batch, err_file, args):
-    print(args.target, args.target == "cpu")
-    if args.target == "cpu": runner = PYTORCH_RUNNER_CPU
-    else: runner = PYTORCH_RUNNER_GPU
+def get_pytorch_runner(packed):
+    def run_pytorch(b_size, dataset, n_batch, err_file, args):
+        print(args.target, args.target == "cpu")
+        if args.target == "cpu": runner = PYTORCH_RUNNER_CPU
+        else: runner = PYTORCH_RUNNER_GPU
 
-    log(args, ' Batch size %d' % (b_size))
-    cmd = [PYTHON, runner, '--target', target, '--batch-size', str(b_size),
-           '--max-batches', str(n_batch), '--dataset', dataset]
-    if args.mem: cmd += ['--mem']
-    if args.target == "cpu": cmd += ['--masked-mha']
+        log(args, ' Batch size %d' % (b_size))
+        cmd = [PYTHON, runner, '--target', target, '--batch-size', str(b_size),
+               '--max-batches', str(n_batch), '--dataset', dataset]
+        if args.mem: cmd += ['--mem']
+        if args.target == "cpu": cmd += ['--masked-mha']
+        if packed: cmd += ['--packed']
 
-    print(' '.join(cmd))
-    out, err = run_cmd(cmd)
-    if err: print(err, file = err_file)
+        print(' '.join(cmd))
+        out, err = com.run_cached(cmd, pooled=args.workers)
+        if err: com.print_err(err, err_file)
 
-    if args.mem: return com.extract_mem(out)
-    else: return com.extract_times(out, 1)[0]
+        framework = 'pytorch_packed' if packed else 'pytorch'
+        if not args.mem: com.save_records(results_records, out, err, framework=framework, dataset=dataset, batch_size=b_size)
+        if args.mem: return com.extract_mem(out)
+        else: return com.extract_times(out, 1)[0]
+    return run_pytorch
 
 def get_ftrans_runner(no_pad):
     def run_ftrans(b_size, dataset, n_batch, err_file, args):
@@ -57,9 +62,9 @@ def get_ftrans_runner(no_pad):
                    str(com.get_dataset_max_len(dataset)), str(num_layers), '1' if no_pad else '0']
 
         # print(' '.join(cmd))
-        out, err = run_cmd(cmd)
+        out, err = com.run_cached(cmd)
         # print(out)
-        if err: print(err, file = err_file)
+        if err: com.print_err(err, err_file)
 
         if args.mem: return com.extract_mem(out)
         else: return com.extract_times(out, 1)[0]
@@ -81,7 +86,7 @@ def get_ftrans_runner(no_pad):
 #         out, err = '', ''
 #         out, err = run_cmd(cmd)
 #         print(out)
-#         if err: print(err, file = err_file)
+#         if err: com.print_err(err, err_file)
 
 #         if args.mem: return com.extract_mem(out)
 #         else: return com.extract_times(out, 1)[0]
@@ -108,10 +113,12 @@ def run_cora(b_sizes, dataset, n_batch, err_file, args):
 
         print(' '.join(cmd))
         out, err = '', ''
-        out, err = run_cmd(cmd)
+        out, err = com.run_cached(cmd)
         # print(out)
-        if err: print(err, file = err_file)
+        if err: com.print_err(err, err_file)
 
+        com.save_records(results_records, out, err, framework='cora', dataset=dataset,
+                         op=os.path.splitext(os.path.basename(runner))[0])
         res = com.extract_time_batches(out)
         print(res)
         for a, b in res.items(): times[a] += b
@@ -128,7 +135,12 @@ parser.add_argument('--gen-libs', dest='gen_libs', default=False, action='store_
 parser.add_argument('--mem', dest='mem', default=False, action='store_true')
 parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
 parser.add_argument('--append', dest='append', default=False, action='store_true')
+parser.add_argument('--workers', dest='workers', default=False, action='store_true')
+parser.add_argument('--cache', dest='cache', default=False, action='store_true')
+parser.add_argument('--parallel', dest='parallel', default=False, action='store_true')
+parser.add_argument('--threads-per-job', dest='threads_per_job', default=8, type=int)
 args = parser.parse_args()
+if args.cache: com.enable_cache(args)
 
 # batch_sizes = [1, 2, 4, 8, 16, 32, 64, 128]
 # batch_sizes = [8]
@@ -142,7 +154,8 @@ datasets = com.cluster_datasets_by_max_len() if args.dataset is None else {com.g
 # datasets = {128:['wiki_128'],48:['cola']}
 
 framework_funs = {
-    'pytorch': lambda b_sizes, *args: com.batchify(b_sizes, run_pytorch, *args),
+    'pytorch': lambda b_sizes, *args: com.batchify(b_sizes, get_pytorch_runner(False), *args),
+    'pytorch_packed': lambda b_sizes, *args: com.batchify(b_sizes, get_pytorch_runner(True), *args),
     'cora': run_cora,
 }
 
@@ -151,18 +164,27 @@ if args.prep_overhead: out_prefix += '_prelude'
 if args.mem: out_prefix += '_mem'
 
 results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+results_records = com.get_records_file(args, out_prefix, 'a' if args.append else 'w')
 header = 'Target,Dataset,Batch Size'
 for framework, func in framework_funs.items(): header += ',' + framework + ' (ms)'
 print(header, file = results_out)
 
+core_sets = com.get_core_sets(args.threads_per_job) if args.parallel else None
 for target in targets:
     for _, dataset_list in datasets.items():
         # if args.gen_libs: generate_tvm_libs(dataset_list[0], target, args);
+        if args.parallel:
+            log(args, 'Running %s %s on %d core sets' % (target, dataset_list, len(core_sets)))
+            parallel_times = com.run_sweep_parallel(framework_funs, dataset_list, batch_sizes, core_sets,
+                                                    args.max_batches, results_err, args)
         for dataset in dataset_list:
             exe_times = {}
             for framework, func in framework_funs.items():
-                log(args, 'Running %s %s %s %s' % (target, dataset, framework, batch_sizes))
-                exe_times[framework] = func(batch_sizes, dataset, args.max_batches, results_err, args)
+                if args.parallel:
+                    exe_times[framework] = parallel_times[(dataset, framework)]
+                else:
+                    log(args, 'Running %s %s %s %s' % (target, dataset, framework, batch_sizes))
+                    exe_times[framework] = func(batch_sizes, dataset, args.max_batches, results_err, args)
                 print(exe_times[framework])
 
             for b_size in batch_sizes:
@@ -174,3 +196,4 @@ for target in targets:
 if not args.stdout:
     results_out.close()
     results_err.close()
+    results_records.close()
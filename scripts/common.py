@@ -1,6 +1,14 @@
 import os
 import sys
+import glob
+import json
+import queue
+import hashlib
+import platform
+import atexit
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
 import utils
 import run_utils
@@ -10,9 +18,256 @@ def get_tvm_target(arg):
     elif arg == "cpu" or arg == "llvm": return "llvm -mcpu=cascadelake"
     elif arg == "arm": return run_utils.get_arm_target()
 
-def run_cmd(cmd):
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.stdout.decode('utf-8'), result.stderr.decode('utf-8')
+PYTHON = 'python3'
+
+# Long-lived runner processes started with --worker, keyed by runner
+# script. See run_utils.serve_worker for the protocol.
+workers = {}
+
+def get_worker(runner):
+    if runner not in workers:
+        workers[runner] = subprocess.Popen([PYTHON, runner, '--worker'], stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE, universal_newlines=True)
+    return workers[runner]
+
+def close_workers():
+    for runner, worker in workers.items():
+        worker.stdin.close()
+        worker.wait()
+    workers.clear()
+atexit.register(close_workers)
+
+def run_in_worker(cmd):
+    assert cmd[0] == PYTHON
+    runner = cmd[1]
+    worker = get_worker(runner)
+    try:
+        print(json.dumps(cmd[2:]), file=worker.stdin, flush=True)
+        reply = worker.stdout.readline()
+    except BrokenPipeError:
+        reply = ''
+    if not reply:
+        del workers[runner]
+        return '', 'Worker for %s exited with status %s\n' % (runner, worker.wait())
+    reply = json.loads(reply)
+    err = reply['err']
+    # A configuration that raised or exited in the worker must not look
+    # like one that merely printed no results, see save_records.
+    if reply['status']: err += 'Worker run of %s exited with status %s\n' % (' '.join(cmd[1:]), reply['status'])
+    return reply['out'], err
+
+def get_cpu_topology():
+    # (package id, core id) of every CPU this process may run on.
+    topology = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        topo_dir = '/sys/devices/system/cpu/cpu%d/topology/' % cpu
+        try:
+            with open(topo_dir + 'physical_package_id') as f: package = int(f.read())
+            with open(topo_dir + 'core_id') as f: core = int(f.read())
+        except (OSError, ValueError):
+            package, core = 0, cpu
+        topology[cpu] = (package, core)
+    return topology
+
+def get_package_cores():
+    # One CPU (hyperthread) of every physical core, by package.
+    packages = {}
+    seen_cores = set()
+    for cpu, (package, core) in get_cpu_topology().items():
+        if (package, core) in seen_cores: continue
+        seen_cores.add((package, core))
+        packages.setdefault(package, []).append(cpu)
+    return packages
+
+def get_core_sets(cores_per_set):
+    """Partition the usable CPUs into disjoint sets of cores_per_set CPUs.
+
+    Only one hyperthread of each physical core is used and no set spans two
+    packages, so concurrent jobs do not share private caches or sockets.
+    """
+    packages = get_package_cores()
+    core_sets = []
+    for package, cpus in sorted(packages.items()):
+        for i in range(0, len(cpus) - cores_per_set + 1, cores_per_set):
+            core_sets.append(cpus[i:i + cores_per_set])
+    if not core_sets:
+        core_sets = [sorted(os.sched_getaffinity(0))[:cores_per_set]]
+    return core_sets
+
+def get_compact_cores(num_cores):
+    """num_cores physical cores, filling a package before using the next."""
+    cpus = [cpu for _, cpus in sorted(get_package_cores().items()) for cpu in cpus]
+    if num_cores > len(cpus): raise ValueError("Only %d physical cores available" % len(cpus))
+    return cpus[:num_cores]
+
+def parse_cpulist(cpulist):
+    # The sysfs list format, e.g. 0-3,8,10-11.
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part: continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += range(int(first), int(last) + 1)
+        else: cpus.append(int(part))
+    return cpus
+
+def get_numa_nodes():
+    # NUMA node of every CPU, empty if the kernel does not report nodes.
+    nodes = {}
+    for node_dir in glob.glob('/sys/devices/system/node/node[0-9]*'):
+        node = int(os.path.basename(node_dir)[len('node'):])
+        try:
+            with open(node_dir + '/cpulist') as f: cpulist = f.read()
+        except OSError:
+            continue
+        for cpu in parse_cpulist(cpulist): nodes[cpu] = node
+    return nodes
+
+# Core set the current scheduler thread is pinned to, see run_parallel.
+pinned = threading.local()
+
+def get_pinned_env(cores):
+    env = dict(os.environ)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TVM_NUM_THREADS']:
+        env[var] = str(len(cores))
+    # Keep TVM's thread pool from re-binding its threads outside the set.
+    env['TVM_BIND_THREADS'] = '0'
+    return env
+
+def run_cmd(cmd, pooled=False):
+    cores = getattr(pinned, 'cores', None)
+    if pooled and cores is None: return run_in_worker(cmd)
+    if cores is None:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.stdout.decode('utf-8'), result.stderr.decode('utf-8')
+    # preexec_fn is not safe with threads. Instead the calling thread pins
+    # itself (pid 0 is the calling thread on Linux) for the spawn, so the
+    # child and every thread it creates start on the core set.
+    prev_cores = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cores)
+    try: proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=get_pinned_env(cores))
+    finally: os.sched_setaffinity(0, prev_cores)
+    out, err = proc.communicate()
+    return out.decode('utf-8'), err.decode('utf-8')
+
+def run_parallel(jobs, core_sets):
+    """Run the callables in jobs concurrently, at most one per core set.
+
+    Commands a job starts through run_cmd are pinned to the job's core set.
+    Returns the jobs' results in order.
+    """
+    free_sets = queue.Queue()
+    for cores in core_sets: free_sets.put(cores)
+
+    def run_job(job):
+        cores = free_sets.get()
+        pinned.cores = cores
+        try:
+            return job()
+        finally:
+            pinned.cores = None
+            free_sets.put(cores)
+
+    with ThreadPoolExecutor(max_workers=len(core_sets)) as executor:
+        return list(executor.map(run_job, jobs))
+
+def run_sweep_parallel(framework_funs, datasets, b_sizes, core_sets, *args):
+    """Run every (dataset, framework, batch size) point of a sweep with run_parallel.
+
+    Returns {(dataset, framework): {batch size: result}}, like calling each
+    framework function with all of b_sizes.
+    """
+    points = [(dataset, framework, b_size) for dataset in datasets for framework in framework_funs for b_size in b_sizes]
+    jobs = [lambda p=p: framework_funs[p[1]]([p[2]], p[0], *args)[p[2]] for p in points]
+    ret = {}
+    for (dataset, framework, b_size), result in zip(points, run_parallel(jobs, core_sets)):
+        ret.setdefault((dataset, framework), {})[b_size] = result
+    return ret
+
+# Content-addressed cache of runner outputs, see run_cached. Disabled
+# unless enable_cache is called.
+cache_dir = None
+file_hashes = {}
+
+def enable_cache(args):
+    global cache_dir
+    cache_dir = os.getcwd() + '/' + args.out_dir + '/cache/'
+    ensure_dir(cache_dir)
+
+def hash_file(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in file_hashes:
+        with open(path, 'rb') as f: file_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+    return file_hashes[key]
+
+def get_tvm_libs():
+    return sorted(glob.glob(run_utils.MODULE_DIR + '*.so'))
+
+RUNNER_SIBLING_DEPS = ['common.py', 'per_op.py']
+
+def get_runner_deps(runner):
+    # Python runners also time code in shared modules next to them and in
+    # the shared run utilities.
+    deps = [os.path.realpath(run_utils.__file__), os.path.realpath(utils.__file__)]
+    for sibling in RUNNER_SIBLING_DEPS:
+        path = os.path.dirname(os.path.realpath(runner)) + '/' + sibling
+        if os.path.isfile(path): deps.append(path)
+    return deps
+
+def get_point_key(cmd, deps=()):
+    """Hash identifying the measurement cmd would make.
+
+    Covers the command line, the contents of every file named on it
+    (runner script, dataset files), the lengths file of a --dataset
+    argument, deps (e.g. generated kernel libraries), the host, and the
+    number of cores the command is pinned to.
+    """
+    key = hashlib.sha256()
+    def add(s):
+        key.update(s.encode('utf-8'))
+        key.update(b'\0')
+
+    add(platform.node())
+    cores = getattr(pinned, 'cores', None)
+    add(str(len(cores)) if cores else '')
+    deps = list(deps)
+    for i, part in enumerate(cmd):
+        add(part)
+        if os.path.isfile(part):
+            add(hash_file(part))
+            if part.endswith('.py'): deps += get_runner_deps(part)
+        elif i > 0 and cmd[i - 1] == '--dataset' and part in run_utils.dataset_files:
+            add(hash_file(get_dataset_file(part)))
+    for dep in deps:
+        add(dep)
+        add(hash_file(dep))
+    return key.hexdigest()
+
+def has_results(out):
+    return any(marker in line or mem_marker in line for line in result_lines(out))
+
+def run_cached(cmd, deps=(), pooled=False):
+    """run_cmd, reusing the output of an earlier run with the same get_point_key.
+
+    Only outputs that contain results are cached, so failed points are
+    retried when a sweep is re-run.
+    """
+    if cache_dir is None: return run_cmd(cmd, pooled)
+    key = get_point_key(cmd, deps)
+    cache_file = cache_dir + key[:2] + '/' + key + '.json'
+    if os.path.exists(cache_file):
+        print('Cached', ' '.join(cmd))
+        with open(cache_file) as f: entry = json.load(f)
+        return entry['out'], entry['err']
+
+    out, err = run_cmd(cmd, pooled)
+    if has_results(out):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%d.%d.tmp' % (cache_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as f: json.dump({'cmd': cmd, 'out': out, 'err': err}, f)
+        os.replace(tmp_file, cache_file)
+    return out, err
 
 def get_all_datasets():
     return list(run_utils.dataset_max_lens.keys())
@@ -32,9 +287,16 @@ def get_dataset_max_len(dataset):
 
 marker = 'RESULTS'
 mem_marker = 'MEM'
+record_marker = run_utils.RECORD_MARKER
 INF = 100000000
+
+def result_lines(out):
+    # Result records are JSON and may contain anything, so keep them away
+    # from the plain marker scans below.
+    return [line for line in out.splitlines() if not line.startswith(record_marker + ',')]
+
 def extract_times(out, expect_num):
-    lines = out.splitlines()
+    lines = result_lines(out)
     res_line = None
     for line in lines:
         if marker in line:
@@ -48,7 +310,7 @@ def extract_times(out, expect_num):
         return [INF] * expect_num
 
 def extract_time_batches(out):
-    lines = out.splitlines()
+    lines = result_lines(out)
     times = {}
     res_line = None
     for line in lines:
@@ -60,7 +322,7 @@ def extract_time_batches(out):
     return times
 
 def extract_time_ops(out):
-    lines = out.splitlines()
+    lines = result_lines(out)
     times = {}
     res_line = None
     for line in lines:
@@ -72,7 +334,7 @@ def extract_time_ops(out):
     return times
 
 def extract_mem(out, expect=1):
-    lines = out.splitlines()
+    lines = result_lines(out)
     res_line = None
     for line in lines:
         if mem_marker in line:
@@ -89,13 +351,50 @@ def extract_mem(out, expect=1):
             return INF
         else: return [INF]*expect
 
+def extract_records(out):
+    records = []
+    for line in out.splitlines():
+        if line.startswith(record_marker + ','):
+            records.append(json.loads(line[len(record_marker) + 1:]))
+    return records
+
+def save_records(records_file, out, err, **context):
+    """Append the records in a runner's output to records_file, tagged with context.
+
+    A runner that produced no record is saved as a failed record carrying
+    the tail of its stderr, instead of silently turning into INF.
+    """
+    if records_file is None: return
+    records = extract_records(out)
+    if not records: records = [{'failed': True, 'err': err[-4096:]}]
+    for record in records: record.update(context)
+    write_lines(records_file, ''.join(json.dumps(record) + '\n' for record in records))
+
+# Sweeps run points on several threads (see run_sweep_parallel) that share
+# the results, records and error files. print issues a write for the text
+# and another for the newline, so lines could interleave across threads.
+output_lock = threading.Lock()
+
+def write_lines(f, text):
+    with output_lock:
+        f.write(text)
+        f.flush()
+
+def print_err(err, err_file):
+    # print(err, file = err_file), safe to call from sweep threads.
+    write_lines(err_file, err + '\n')
+
+def read_records(filename):
+    with open(filename) as records_file:
+        return [json.loads(line) for line in records_file if line.strip()]
+
 def batchify(b_sizes, fun, *args):
     result = {}
     for b_size in b_sizes: result[b_size] = fun(b_size, *args)
     return result
 
 def extract_times_multiple(out):
-    lines = out.splitlines()
+    lines = result_lines(out)
     res_lines = []
     for line in lines:
         if marker in line:
@@ -120,6 +419,13 @@ def get_out_files(args, prefix, mode = 'w'):
     results_err = sys.stderr if args.stdout else open(out_dir + '/' + prefix + '_errors' + target_part + '.txt', mode)
     return results_out, results_err
 
+def get_records_file(args, prefix, mode = 'w'):
+    if args.stdout: return None
+    out_dir = os.getcwd() + '/' + args.out_dir
+    ensure_dir(out_dir)
+    target_part = '_' + args.target if len(args.target) > 0 else ''
+    return open(out_dir + '/' + prefix + '_records' + target_part + '.jsonl', mode)
+
 
 def log(args, string):
     if not args.stdout:
@@ -133,7 +439,7 @@ def run_linearization(err_file, dataset, b_size, n_batch, *args):
     print(' '.join(cmd))
     out, err = run_cmd(cmd)
     if err:
-        print(err, file = err_file)
+        print_err(err, err_file)
         out = 'ERROR'
 
     return extract_times(out)
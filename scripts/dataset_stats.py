@@ -1,6 +1,7 @@
 import os
 import sys
 import common as com
+import run_utils
 from common import run_cmd, INF, get_out_files, log, run_linearization
 import argparse
 
@@ -84,16 +85,12 @@ results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append el
 header = 'Dataset,Min,Mean,Max'
 print(header, file = results_out)
 
-def read_lengths(f, n):
-    data_lines = [int(line.strip()) for line in open(f, "r", errors='replace')]
-    return data_lines[0:n]
-
 def get_stats(l):
     return min(l), sum(l) / len(l), max(l)
 
 for dataset in datasets:
     ds_file = com.get_dataset_file(dataset)
-    lengths = read_lengths(ds_file, args.max_batches * args.batch_size)
+    lengths = run_utils.read_lengths(ds_file, count = args.max_batches * args.batch_size).tolist()
     m1, m2, m3 = get_stats(lengths)
     out_str = '%s,%d,%d,%d' % (dataset, m1, m2, m3)
     print(out_str, file = results_out)
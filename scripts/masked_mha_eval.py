@@ -21,6 +21,8 @@ def generate_tvm_libs(framework, dataset, args):
         print(' '.join(cmd))
         out, err = run_cmd(cmd)
         print(out, err)
+        # Workers keep the previous libraries loaded.
+        com.close_workers()
 
 def run_pytorch(b_size, dataset, n_batch, err_file, args):
     log(args, ' Batch size %d' % (b_size))
@@ -29,10 +31,11 @@ def run_pytorch(b_size, dataset, n_batch, err_file, args):
     cmd += ['--masked-mha']
     print(' '.join(cmd))
     out, err = '', ''
-    out, err = run_cmd(cmd)
+    out, err = com.run_cached(cmd, pooled=args.workers)
     print(out)
     if err: print(err, file = err_file)
 
+    com.save_records(results_records, out, err, framework='pytorch', dataset=dataset, batch_size=b_size)
     return com.extract_times(out, 1)[0]
 
 def get_tvm_runner(masked):
@@ -47,10 +50,12 @@ def get_tvm_runner(masked):
         else: cmd += ['--plain-mha']
         print(' '.join(cmd))
         out, err = '', ''
-        out, err = run_cmd(cmd)
+        out, err = com.run_cached(cmd, deps=com.get_tvm_libs(), pooled=args.workers)
         print(out)
         if err: print(err, file = err_file)
 
+        com.save_records(results_records, out, err, framework='cora_masked' if masked else 'cora_plain',
+                         dataset=dataset, batch_size=b_size)
         return com.extract_times(out, 1)[0]
     return run_tvm;
 
@@ -62,7 +67,10 @@ parser.add_argument('--max-batches', dest='max_batches', default=1, type=int)
 parser.add_argument('--gen-libs', dest='gen_libs', default=False, action='store_true')
 parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
 parser.add_argument('--append', dest='append', default=False, action='store_true')
+parser.add_argument('--workers', dest='workers', default=False, action='store_true')
+parser.add_argument('--cache', dest='cache', default=False, action='store_true')
 args = parser.parse_args()
+if args.cache: com.enable_cache(args)
 
 batch_sizes = [32, 64, 128]
 target = 'cuda'
@@ -79,6 +87,7 @@ framework_funs = {
 out_prefix = 'bert_layer_mmha'
 
 results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+results_records = com.get_records_file(args, out_prefix, 'a' if args.append else 'w')
 header = 'Target,Dataset,Batch Size'
 for framework, func in framework_funs.items(): header += ',' + framework + ' (ms)'
 print(header, file = results_out)
@@ -107,3 +116,4 @@ for _, dataset_list in datasets.items():
 if not args.stdout:
     results_out.close()
     results_err.close()
+    results_records.close()
@@ -6,6 +6,7 @@ import argparse
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 TVM_EXE_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/masked_mha.py'
+PYTORCH_RUNNER = SCRIPT_DIR + '/../bert_layer/pytorch/layer.py'
 TVM_LIB_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/gen_libs.sh'
 FTRANS_EXE_RUNNER = SCRIPT_DIR + '/../bert_layer/faster_transformer/run_encoder_sample.sh'
 PYTHON = 'python3'
@@ -15,6 +16,8 @@ def generate_tvm_libs(dataset, args):
     print(' '.join(cmd))
     out, err = run_cmd(cmd)
     print(out, err)
+    # Workers keep the previous libraries loaded.
+    com.close_workers()
 
 def run_ftrans(b_size, padding, dataset, n_batch, err_file, args):
     log(args, ' Batch size %d' % (b_size))
@@ -22,16 +25,26 @@ def run_ftrans(b_size, padding, dataset, n_batch, err_file, args):
     cmd = [FTRANS_EXE_RUNNER, com.get_dataset_file(dataset), str(b_size), str(n_batch),
            str(com.get_dataset_max_len(dataset)), str(num_layers), '0' if padding else '1']
 
-    out, err = run_cmd(cmd)
+    out, err = com.run_cached(cmd)
+    if err: print(err, file = err_file)
+    return com.extract_time_ops(out)
+
+def run_pytorch(b_size, dataset, n_batch, err_file, args):
+    log(args, ' Batch size %d' % (b_size))
+    cmd = [PYTHON, PYTORCH_RUNNER, '--target', target, '--batch-size', str(b_size),
+           '--max-batches', str(n_batch), '--dataset', dataset, '--per-op']
+    out, err = com.run_cached(cmd, pooled=args.workers)
     if err: print(err, file = err_file)
+    com.save_records(results_records, out, err, framework='pytorch', dataset=dataset, batch_size=b_size)
     return com.extract_time_ops(out)
 
 def run_cora(b_size, dataset, n_batch, err_file, args):
     log(args, ' Batch size %d' % (b_size))
     cmd = [PYTHON, TVM_EXE_RUNNER, '--target', com.get_tvm_target(target), '--batch-size', str(b_size),
            '--max-batches', str(n_batch), '--dataset', dataset, '--per-op']
-    out, err = run_cmd(cmd)
+    out, err = com.run_cached(cmd, deps=com.get_tvm_libs(), pooled=args.workers)
     if err: print(err, file = err_file)
+    com.save_records(results_records, out, err, framework='cora', dataset=dataset, batch_size=b_size)
     return com.extract_time_ops(out)
 
 parser = argparse.ArgumentParser()
@@ -43,7 +56,10 @@ parser.add_argument('--prep-overhead', dest='prep_overhead', default=False, acti
 parser.add_argument('--gen-libs', dest='gen_libs', default=False, action='store_true')
 parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
 parser.add_argument('--append', dest='append', default=False, action='store_true')
+parser.add_argument('--workers', dest='workers', default=False, action='store_true')
+parser.add_argument('--cache', dest='cache', default=False, action='store_true')
 args = parser.parse_args()
+if args.cache: com.enable_cache(args)
 
 data_points = [('race', 128), ('cola', 32)]
 # data_points = [('race', 128)]
@@ -54,6 +70,7 @@ out_prefix = 'per_op_times'
 if args.prep_overhead: out_prefix += '_prelude'
 
 results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+results_records = com.get_records_file(args, out_prefix, 'a' if args.append else 'w')
 header = 'Dataset,Batch Size,Framework,Op,Time'
 print(header, file = results_out)
 
@@ -67,6 +84,12 @@ for dataset, b_size in data_points:
     results_out.flush()
 
     if not args.prep_overhead:
+        pt_times = run_pytorch(b_size, dataset, args.max_batches, results_err, args)
+        for op, time in pt_times.items():
+            out_str = '%s,%d,%s,%s,%g' % (dataset, b_size, 'pytorch', op, time)
+            print(out_str, file = results_out)
+        results_out.flush()
+
         ft_times = run_ftrans(b_size, False, dataset, args.max_batches, results_err, args)
         for op, time in ft_times.items():
             out_str = '%s,%d,%s,%s,%g' % (dataset, b_size, 'ftrans_nopad', op, time)
@@ -82,3 +105,4 @@ for dataset, b_size in data_points:
 if not args.stdout:
     results_out.close()
     results_err.close()
+    results_records.close()
@@ -0,0 +1,51 @@
+import os
+import sys
+import common as com
+import argparse
+
+def record_key(record):
+    return (record.get('framework', ''), record.get('dataset', ''), record.get('batch_size', ''),
+            record.get('op', record.get('name')) or '')
+
+def index_records(records):
+    ret = {}
+    for record in records: ret[record_key(record)] = record
+    return ret
+
+def rel_change(new, old):
+    return (new - old) / old if old else 0.0
+
+parser = argparse.ArgumentParser()
+parser.add_argument('records', type=str)
+parser.add_argument('--baseline', dest='baseline', nargs='?', default=None)
+parser.add_argument('--threshold', dest='threshold', default=0.05, type=float)
+args = parser.parse_args()
+
+records = index_records(com.read_records(args.records))
+baseline = index_records(com.read_records(args.baseline)) if args.baseline else {}
+
+header = 'Framework,Dataset,Batch Size,Op,Mean (ms),P50 (ms),P99 (ms),Std (ms)'
+if args.baseline: header += ',Base P50 (ms),Base P99 (ms),P50 Change,P99 Change'
+print(header)
+
+regressions = []
+for key, record in records.items():
+    framework, dataset, b_size, op = key
+    out_str = '%s,%s,%s,%s' % (framework, dataset, b_size, op)
+    if record.get('failed'):
+        print(out_str + ',FAILED')
+        continue
+    out_str += ',%g,%g,%g,%g' % (record['mean'], record['p50'], record['p99'], record['var'] ** 0.5)
+    if args.baseline:
+        base = baseline.get(key)
+        if base is None or base.get('failed'):
+            out_str += ',,,,'
+        else:
+            p50_change = rel_change(record['p50'], base['p50'])
+            p99_change = rel_change(record['p99'], base['p99'])
+            out_str += ',%g,%g,%.2f%%,%.2f%%' % (base['p50'], base['p99'], p50_change * 100, p99_change * 100)
+            if p50_change > args.threshold or p99_change > args.threshold: regressions.append(key)
+    print(out_str)
+
+for key in regressions:
+    print('REGRESSION', *key, sep=',', file = sys.stderr)
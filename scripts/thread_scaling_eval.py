@@ -0,0 +1,141 @@
+import os
+import sys
+import common as com
+import run_utils
+from common import run_cmd, INF, get_out_files, log
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+PYTORCH_RUNNER = SCRIPT_DIR + '/../bert_layer/pytorch/layer_cpu.py'
+TVM_EXE_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/masked_mha_cpu.py'
+TVM_LIB_RUNNER = SCRIPT_DIR + '/../bert_layer/tvm/gen_libs_cpu.sh'
+MKL_RUNNER = SCRIPT_DIR + '/../vbatch_gemm/mkl/vbatch_gemm'
+PYTHON = 'python3'
+NUM_HEADS = 8
+HEAD_SIZE = 64
+
+# Strong scaling of the CPU runners: the same batches on a growing number
+# of physical cores. Every point is pinned to a compact core set (one
+# package filled before the next) and the runner is told the thread
+# count, so the curve also shows where a second socket or NUMA node
+# comes in.
+
+def generate_tvm_libs(dataset, args):
+    cmd = [TVM_LIB_RUNNER, dataset, '0', '0', '0']
+    print(' '.join(cmd))
+    out, err = run_cmd(cmd)
+    print(out, err)
+
+def run_pytorch(b_size, dataset, n_batch, threads, err_file, args):
+    cmd = [PYTHON, PYTORCH_RUNNER, '--target', 'cpu', '--batch-size', str(b_size),
+           '--max-batches', str(n_batch), '--dataset', dataset, '--masked-mha', '--threads', str(threads)]
+    print(' '.join(cmd))
+    out, err = com.run_cached(cmd)
+    if err: print(err, file = err_file)
+    return out, err, com.extract_times(out, 1)[0]
+
+def run_cora(b_size, dataset, n_batch, threads, err_file, args):
+    cmd = [PYTHON, TVM_EXE_RUNNER, '--target', com.get_tvm_target(args.target), '--batch-size', str(b_size),
+           '--max-batches', str(n_batch), '--dataset', dataset, '--masked-mha', '--threads', str(threads)]
+    print(' '.join(cmd))
+    out, err = com.run_cached(cmd, deps=com.get_tvm_libs())
+    if err: print(err, file = err_file)
+    return out, err, com.extract_times(out, 1)[0]
+
+def get_mkl_data_file(b_size, dataset, n_batch, args):
+    """Write the GEMMs of masked MHA on the dataset's batches for the MKL runner.
+
+    Every sequence and head contributes its QK^T and attention times V
+    GEMMs as m n k lines, so a batch is b_size * NUM_HEADS * 2 GEMMs.
+    Returns the file and the number of full batches in it.
+    """
+    batches = [batch for batch in run_utils.get_nlp_batches(b_size, n_batch, dataset) if len(batch) == b_size]
+    data_dir = os.getcwd() + '/' + args.out_dir + '/thread_scaling_data'
+    com.ensure_dir(data_dir)
+    data_file_path = '%s/%s_%d_%d.txt' % (data_dir, dataset, b_size, n_batch)
+    with open(data_file_path, 'w') as data_file:
+        # The runner skips the first line, like the header of vbatch_gemm/data.txt.
+        print('m n k', file = data_file)
+        for batch in batches:
+            for length in batch:
+                for head in range(NUM_HEADS):
+                    print(length, length, HEAD_SIZE, file = data_file)
+                    print(length, HEAD_SIZE, length, file = data_file)
+    return data_file_path, len(batches)
+
+def run_mkl(b_size, dataset, n_batch, threads, err_file, args):
+    # The vbatch GEMM binary takes its thread count from MKL_NUM_THREADS,
+    # which the pinned run sets, so its command line does not tell the
+    # points apart and it is not cached.
+    data_file_path, n_batch = get_mkl_data_file(b_size, dataset, n_batch, args)
+    cmd = [MKL_RUNNER, str(b_size * NUM_HEADS * 2), str(n_batch), '0', data_file_path, str(250), str(1)]
+    print(' '.join(cmd))
+    out, err = run_cmd(cmd)
+    if err: print(err, file = err_file)
+    return out, err, com.extract_times(out, 1)[0]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--target', nargs='?', default='cpu')
+parser.add_argument('--out-dir', dest='out_dir', nargs='?', default='perf_results')
+parser.add_argument('--dataset', nargs='?', default=None)
+parser.add_argument('--batch-sizes', dest='batch_sizes', nargs='+', default=[32, 128], type=int)
+parser.add_argument('--threads', dest='threads', nargs='+', default=[1, 2, 4, 8, 16, 32], type=int)
+parser.add_argument('--max-batches', dest='max_batches', default=1, type=int)
+parser.add_argument('--gen-libs', dest='gen_libs', default=False, action='store_true')
+parser.add_argument('--stdout', dest='stdout', default=False, action='store_true')
+parser.add_argument('--append', dest='append', default=False, action='store_true')
+parser.add_argument('--cache', dest='cache', default=False, action='store_true')
+args = parser.parse_args()
+if args.cache: com.enable_cache(args)
+
+datasets = com.get_all_datasets() if args.dataset is None else [args.dataset]
+thread_counts = sorted(set(args.threads))
+
+framework_funs = {
+    'pytorch': run_pytorch,
+    'cora': run_cora,
+    'mkl': run_mkl,
+}
+
+out_prefix = 'thread_scaling'
+results_out, results_err = get_out_files(args, out_prefix, 'a' if args.append else 'w')
+results_records = com.get_records_file(args, out_prefix, 'a' if args.append else 'w')
+header = 'Framework,Dataset,Batch Size,Threads,NUMA Nodes,Time (ms),Speedup,Efficiency'
+print(header, file = results_out)
+
+numa_nodes = com.get_numa_nodes()
+core_sets = {}
+for threads in thread_counts:
+    try: core_sets[threads] = com.get_compact_cores(threads)
+    except ValueError as e: log(args, 'Skipping %d threads: %s' % (threads, e))
+
+for dataset in datasets:
+    if args.gen_libs: generate_tvm_libs(dataset, args)
+    for b_size in args.batch_sizes:
+        for framework, func in framework_funs.items():
+            base = None
+            for threads, cores in core_sets.items():
+                log(args, 'Running %s %s %d on %d threads' % (framework, dataset, b_size, threads))
+                # NUMA nodes the pinned cores span, 1 if the kernel reports none.
+                nodes = len(set(numa_nodes.get(cpu, 0) for cpu in cores))
+                com.pinned.cores = cores
+                try: out, err, time = func(b_size, dataset, args.max_batches, threads, results_err, args)
+                finally: com.pinned.cores = None
+                com.save_records(results_records, out, err, framework=framework, dataset=dataset,
+                                 batch_size=b_size, threads=threads, numa_nodes=nodes)
+
+                # Speedup and efficiency are relative to the smallest
+                # thread count that ran, scaled to its thread count.
+                if base is None and time != INF: base = (threads, time)
+                if base is None or time == INF: speedup, efficiency = 0.0, 0.0
+                else:
+                    speedup = base[1] / time
+                    efficiency = speedup * base[0] / threads
+                print('%s,%s,%d,%d,%d,%g,%g,%g' % (framework, dataset, b_size, threads, nodes, time,
+                                                   speedup, efficiency), file = results_out)
+            results_out.flush()
+
+if not args.stdout:
+    results_out.close()
+    results_err.close()
+    results_records.close()
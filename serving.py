@@ -0,0 +1,67 @@
+import numpy as np
+
+# Open-loop serving simulation. Requests, one per sequence length, arrive
+# independently of how fast they are served. They queue in front of a
+# single server that batches them and runs one batch at a time. Batch
+# service times come from a callback, typically a runner timing the model
+# on the batch's lengths, so the simulation only models the queueing.
+
+def poisson_arrivals(num_requests, rate, seed=0):
+    # Arrival times in seconds for a Poisson process of rate requests/s.
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.exponential(1.0 / rate, num_requests))
+
+def trace_arrivals(filename, num_requests, scale=1.0):
+    # Arrival times from a file of inter-arrival gaps in seconds, one per
+    # line, scaled by 1 / scale so the same trace can be replayed at
+    # several loads.
+    gaps = np.loadtxt(filename, dtype='float64', ndmin=1)[:num_requests]
+    if len(gaps) < num_requests: raise ValueError("Trace %s has only %d gaps" % (filename, len(gaps)))
+    return np.cumsum(gaps / scale)
+
+def simulate(lengths, arrivals, service_time, max_batch_size, window, max_tokens=None):
+    """Simulate serving requests of the given lengths arriving at arrivals (s).
+
+    When the server is idle it waits for the oldest queued request's
+    batching window (s) to expire or for the batch to fill up, whichever
+    is first. A batch is full at max_batch_size requests or, with
+    max_tokens, when the next request would push the padded batch over the
+    budget. service_time(lengths) returns the batch's time in seconds.
+    Returns the completion time of every request.
+    """
+    num_requests = len(lengths)
+    finish = np.zeros(num_requests)
+    server_free = 0.0
+    next_req = 0
+    while next_req < num_requests:
+        start = max(server_free, arrivals[next_req])
+        deadline = max(start, arrivals[next_req] + window)
+        end = next_req + 1
+        batch_max = lengths[next_req]
+        # Requests join while they arrive before dispatch and still fit.
+        while end < num_requests and end - next_req < max_batch_size:
+            if arrivals[end] > deadline: break
+            new_max = max(batch_max, lengths[end])
+            if max_tokens and new_max * (end - next_req + 1) > max_tokens: break
+            batch_max = new_max
+            end += 1
+        full = end - next_req == max_batch_size or (end < num_requests and arrivals[end] <= deadline)
+        # A full batch leaves as soon as its last request is there.
+        dispatch = max(start, arrivals[end - 1]) if full else deadline
+        server_free = dispatch + service_time(np.array(lengths[next_req:end], 'int32'))
+        finish[next_req:end] = server_free
+        next_req = end
+    return finish
+
+def summarize(arrivals, finish, slo=None):
+    latencies = (finish - arrivals) * 1000.0
+    span = finish[-1] - arrivals[0]
+    ret = {
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+        'throughput': float(len(latencies) / span),
+    }
+    # Goodput counts only the requests that met the latency SLO (ms).
+    ret['goodput'] = float(np.sum(latencies <= slo)) / span if slo else ret['throughput']
+    return ret